@@ -1,11 +1,14 @@
 import tkinter as tk
 from tkinter import ttk, messagebox, filedialog
 from typing import Dict
-import threading
+from datetime import datetime
+import queue
+import multiprocessing
 import os
 from PIL import Image, ImageTk
 
 import document_gen as dg
+from render_service import RenderService, render_document
 
 
 class DocGenApp(tk.Tk):
@@ -30,7 +33,17 @@ class DocGenApp(tk.Tk):
         self.font_var = tk.StringVar(value="手写-马善政")
         self._img = None
         self._history_items = []
+        self._preview_job = None
+        self._search_job = None
+        self._hist_job = None
+        self._hist_page = 0
+        self._hist_more = False
+        # Worker callbacks are queued here and run on the Tk thread by _drain_ui
+        self._ui_calls: "queue.Queue" = queue.Queue()
+        self.renderer = RenderService(workers=2, dispatch=self._ui_calls.put)
         self._build_ui()
+        self.after(50, self._drain_ui)
+        self.protocol("WM_DELETE_WINDOW", self._on_close)
 
     def _build_ui(self):
         paned = ttk.Panedwindow(self, orient=tk.HORIZONTAL)
@@ -72,7 +85,7 @@ class DocGenApp(tk.Tk):
         self.search_var = tk.StringVar()
         sbar = ttk.Entry(frame, textvariable=self.search_var)
         sbar.pack(fill=tk.X, padx=10)
-        sbar.bind("<KeyRelease>", lambda e: self._refresh_templates())
+        sbar.bind("<KeyRelease>", lambda e: self._schedule_search())
         self.tpl_var = tk.StringVar()
         self.tpl_cb = ttk.Combobox(frame, textvariable=self.tpl_var, state="readonly")
         self.tpl_cb.pack(fill=tk.X, padx=10, pady=10)
@@ -88,9 +101,10 @@ class DocGenApp(tk.Tk):
         left_grp.pack(side=tk.LEFT, fill=tk.X, expand=True)
         right_grp.pack(side=tk.RIGHT)
         ttk.Label(left_grp, text="风格").pack(side=tk.LEFT, padx=(10, 2))
-        style_cb = ttk.Combobox(left_grp, textvariable=self.style_var, values=["formal", "neutral", "strict"], state="readonly", width=10)
+        style_cb = ttk.Combobox(left_grp, textvariable=self.style_var, values=dg.style_names(), state="readonly", width=10)
+        style_cb.configure(postcommand=lambda: style_cb.configure(values=dg.style_names()))
         style_cb.pack(side=tk.LEFT)
-        style_cb.bind("<<ComboboxSelected>>", lambda e: self._generate())
+        style_cb.bind("<<ComboboxSelected>>", lambda e: self._schedule_preview(0))
         ttk.Button(left_grp, text="智能填充", command=self._smart_fill).pack(side=tk.LEFT, padx=10)
         ttk.Label(left_grp, text="字体").pack(side=tk.LEFT, padx=(10, 2))
         font_cb = ttk.Combobox(left_grp, textvariable=self.font_var, values=["手写-马善政", "手写-芝蔓行", "手写-龙藏", "宋体", "楷体", "黑体"], state="readonly", width=12)
@@ -125,25 +139,42 @@ class DocGenApp(tk.Tk):
         ttk.Button(bbar, text="保存TXT", command=self._save_txt).pack(side=tk.LEFT)
         ttk.Button(bbar, text="保存DOCX", command=self._save_docx).pack(side=tk.LEFT, padx=8)
         ttk.Label(frame, text="历史记录").pack(anchor=tk.W, padx=10)
+        hbar = ttk.Frame(frame)
+        hbar.pack(fill=tk.X, padx=10, pady=(0, 4))
+        self.hist_query = tk.StringVar()
+        hq = ttk.Entry(hbar, textvariable=self.hist_query)
+        hq.pack(side=tk.LEFT, fill=tk.X, expand=True)
+        hq.bind("<KeyRelease>", lambda e: self._schedule_history())
+        self.hist_tpl = tk.StringVar(value="全部")
+        htpl = ttk.Combobox(hbar, textvariable=self.hist_tpl, state="readonly", width=14)
+        htpl.configure(postcommand=lambda: htpl.configure(values=["全部"] + [f"{x['name']} ({x['id']})" for x in dg.template_list()]))
+        htpl.pack(side=tk.LEFT, padx=4)
+        htpl.bind("<<ComboboxSelected>>", lambda e: self._history_refresh(0))
+        ttk.Button(hbar, text="<", width=2, command=lambda: self._history_refresh(self._hist_page - 1)).pack(side=tk.LEFT)
+        ttk.Button(hbar, text=">", width=2, command=lambda: self._history_refresh(self._hist_page + 1)).pack(side=tk.LEFT)
         self.hist_var = tk.StringVar()
         self.hist_cb = ttk.Combobox(frame, textvariable=self.hist_var, state="readonly")
         self.hist_cb.pack(fill=tk.X, padx=10, pady=(0, 10))
         ttk.Button(frame, text="恢复", command=self._restore_history).pack(anchor=tk.W, padx=10)
 
+    def _schedule_search(self):
+        if self._search_job is not None:
+            self.after_cancel(self._search_job)
+        self._search_job = self.after(150, self._refresh_templates)
+
     def _refresh_templates(self):
-        q = (self.search_var.get() or "").strip().lower()
-        items = dg.template_list()
-        values = []
-        for item in items:
-            name = f"{item['name']} ({item['id']})"
-            blob = (item["id"] + item["name"] + item["description"]).lower()
-            if q and q not in blob:
-                continue
-            values.append(name)
-        self.tpl_cb["values"] = values
+        self._search_job = None
+        items = dg.search_templates(self.search_var.get())
+        values = [f"{item['name']} ({item['id']})" for item in items]
+        if list(self.tpl_cb["values"]) != values:
+            self.tpl_cb["values"] = values
         self.count_var.set(str(len(values)))
         if values:
-            self.tpl_cb.current(0)
+            # Keep the current template (and its form) if it still matches
+            ids = [item["id"] for item in items]
+            cur = ids.index(self.selected_template) if self.selected_template in ids else 0
+            if self.tpl_cb.current() != cur:
+                self.tpl_cb.current(cur)
             self._on_template_select()
         else:
             self.tpl_cb.set("")
@@ -156,13 +187,11 @@ class DocGenApp(tk.Tk):
         if not text:
             return
         tid = text.split("(")[-1][:-1]
+        if tid == self.selected_template:
+            return
         self.selected_template = tid
-        desc = ""
-        for it in dg.template_list():
-            if it["id"] == tid:
-                desc = it["description"]
-                break
-        self.desc_var.set(desc)
+        t = dg.get_template(tid)
+        self.desc_var.set(t.description if t else "")
         self._build_form_fields()
 
     def _clamp_sashes(self):
@@ -206,8 +235,10 @@ class DocGenApp(tk.Tk):
             ent = ttk.Entry(self.form_container)
             lab.grid(row=i, column=0, sticky="w", padx=4, pady=4)
             ent.grid(row=i, column=1, sticky="ew", padx=4, pady=4)
+            ent.bind("<KeyRelease>", lambda e: self._schedule_preview())
             self.form_container.grid_columnconfigure(1, weight=1)
             self.entries[f] = ent
+        self._schedule_preview(0)
 
     def _collect_data(self) -> Dict[str, str]:
         r: Dict[str, str] = {}
@@ -215,9 +246,42 @@ class DocGenApp(tk.Tk):
             r[k] = e.get().strip()
         return r
 
+    def _schedule_preview(self, delay: int = 300):
+        # Text-only preview, debounced: the handwriting image is rendered by 生成
+        if self._preview_job is not None:
+            self.after_cancel(self._preview_job)
+        self._preview_job = self.after(delay, self._live_preview)
+
+    def _live_preview(self):
+        self._preview_job = None
+        if not self.selected_template:
+            return
+        try:
+            text = dg.generate_document(self.selected_template, self._collect_data(), self.style_var.get())
+        except Exception as e:
+            self.status_var.set(f"预览失败：{e}")
+            return
+        self._update_preview_text(text)
+
     def _update_preview_text(self, text: str):
-        self.preview_text.delete("1.0", tk.END)
-        self.preview_text.insert(tk.END, text)
+        old = self.preview_text.get("1.0", "end-1c")
+        if old != text:
+            if max(old + text, default="") > "\uffff":
+                # Tk indexes astral characters differently; just replace everything
+                self.preview_text.delete("1.0", tk.END)
+                self.preview_text.insert(tk.END, text)
+            else:
+                # Replace only the span between the common prefix and suffix
+                n = min(len(old), len(text))
+                i = 0
+                while i < n and old[i] == text[i]:
+                    i += 1
+                j = 0
+                while j < n - i and old[-1 - j] == text[-1 - j]:
+                    j += 1
+                start = f"1.0 + {i} chars"
+                self.preview_text.delete(start, f"1.0 + {len(old) - j} chars")
+                self.preview_text.insert(start, text[i:len(text) - j])
         if self.view_mode.get() == "text":
             self.preview_image.pack_forget()
             self.preview_text.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
@@ -274,10 +338,7 @@ class DocGenApp(tk.Tk):
         path = filedialog.asksaveasfilename(defaultextension=".docx", filetypes=[("Word", "*.docx")])
         if not path:
             return
-        doc = docx.Document()
-        for line in text.splitlines():
-            doc.add_paragraph(line)
-        doc.save(path)
+        dg.save_docx(text, path)
         try:
             dg.record_training(self.selected_template, data)
         except Exception:
@@ -287,26 +348,42 @@ class DocGenApp(tk.Tk):
     def _generate(self):
         if not self.selected_template:
             return
+        tid = self.selected_template
         data = self._collect_data()
         style = self.style_var.get()
+        hw_style = {"font_name": self.font_var.get()}
+        try:
+            self.renderer.submit("form", render_document, tid, data, style, hw_style, on_done=self._on_generated, on_error=self._on_generate_error)
+        except RuntimeError as e:
+            self.status_var.set(str(e))
+            return
         self._set_busy(True)
-        def run():
-            try:
-                text = dg.generate_document(self.selected_template, data, style)
-                out_dir = os.path.join(os.getcwd(), "handwrite_output")
-                os.makedirs(out_dir, exist_ok=True)
-                img_path = dg.generate_handwriting_image(text, os.path.join(out_dir, f"{self.selected_template}_{int(__import__('time').time())}.png"), {"font_name": self.font_var.get()})
-                dg.add_history(self.selected_template, data, text, img_path)
-                self._history_refresh()
-                self._update_preview_text(text)
-                if self.view_mode.get() == "image":
-                    self._show_image(img_path)
-                self.status_var.set(f"已生成 {len(text)} 字符，图片：{img_path}")
-            except Exception as e:
-                messagebox.showerror("错误", str(e))
-            finally:
-                self.after(0, lambda: self._set_busy(False))
-        threading.Thread(target=run, daemon=True).start()
+
+    def _on_generated(self, result):
+        text, img_path = result
+        self._history_refresh()
+        self._update_preview_text(text)
+        if self.view_mode.get() == "image":
+            self._show_image(img_path)
+        self._set_busy(self.renderer.busy())
+        self.status_var.set(f"已生成 {len(text)} 字符，图片：{img_path}")
+
+    def _on_generate_error(self, e):
+        self._set_busy(self.renderer.busy())
+        self.status_var.set("生成失败")
+        messagebox.showerror("错误", str(e))
+
+    def _drain_ui(self):
+        try:
+            while True:
+                self._ui_calls.get_nowait()()
+        except queue.Empty:
+            pass
+        self.after(50, self._drain_ui)
+
+    def _on_close(self):
+        self.renderer.shutdown(wait=False)
+        self.destroy()
 
     def _set_busy(self, busy: bool):
         if busy:
@@ -345,7 +422,7 @@ class DocGenApp(tk.Tk):
     def _toggle_view(self):
         if self.view_mode.get() == "text":
             self.view_mode.set("image")
-            items = dg.list_history()
+            items = dg.list_history_entries(limit=1)
             if items:
                 p = items[0].get("image_path")
                 if p and os.path.exists(p):
@@ -372,17 +449,31 @@ class DocGenApp(tk.Tk):
             except Exception:
                 pass
 
-    def _history_refresh(self):
-        items = dg.list_history()
+    def _schedule_history(self):
+        if self._hist_job is not None:
+            self.after_cancel(self._hist_job)
+        self._hist_job = self.after(250, lambda: self._history_refresh(0))
+
+    def _history_refresh(self, page: int = 0):
+        self._hist_job = None
+        if page > self._hist_page and not self._hist_more:
+            return
+        tpl = self.hist_tpl.get()
+        tid = tpl.split("(")[-1][:-1] if tpl and tpl != "全部" else None
+        res = dg.history_page(max(0, page), 50, tid, self.hist_query.get())
+        self._hist_page = res["page"]
+        self._hist_more = res["has_more"]
+        items = res["items"]
         self._history_items = items
         values = []
         for it in items:
-            ts = it.get("ts")
-            tid = it.get("template_id")
-            values.append(f"{tid}-{ts}")
+            ts = datetime.fromtimestamp(it["ts"]).strftime("%m-%d %H:%M")
+            values.append(f"{ts} {it['template_id']} {it['title']}")
         self.hist_cb["values"] = values
         if values:
             self.hist_cb.current(0)
+        else:
+            self.hist_cb.set("")
 
     def _restore_history(self):
         idx = self.hist_cb.current()
@@ -390,7 +481,10 @@ class DocGenApp(tk.Tk):
             return
         if idx >= len(self._history_items):
             return
-        it = self._history_items[idx]
+        it = dg.get_history(self._history_items[idx]["id"])
+        if not it:
+            self.status_var.set("该历史记录已被清理")
+            return
         data = it.get("data", {})
         for k, e in self.entries.items():
             e.delete(0, tk.END)
@@ -398,9 +492,16 @@ class DocGenApp(tk.Tk):
             e.insert(0, v)
         text = it.get("text", "")
         self._update_preview_text(text)
-        p = it.get("image_path")
-        if p and os.path.exists(p) and self.view_mode.get() == "image":
-            self._show_image(p)
+        if self.view_mode.get() == "image":
+            p = it.get("image_path")
+            if not (p and os.path.exists(p)) and text:
+                # Cache is content-addressed: re-rendering the same text is cheap
+                try:
+                    p = dg.render_handwriting_cached(text, {"font_name": self.font_var.get()})
+                except Exception:
+                    p = None
+            if p and os.path.exists(p):
+                self._show_image(p)
 
 
 def main():
@@ -409,4 +510,5 @@ def main():
 
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
     main()
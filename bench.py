@@ -0,0 +1,38 @@
+import timeit
+
+import document_gen as dg
+
+
+def _sample(t: dg.Template) -> dict:
+    return {f: f"示例{f}" * 4 for f in t.fields}
+
+
+def bench_render(number: int = 20000) -> None:
+    for t in dg._registry.all():
+        d = _sample(t)
+
+        def legacy():
+            x = dict(d)
+            for k in [f for f in t.fields if f not in x]:
+                x[k] = ""
+            return t.body.format(**x)
+
+        a = timeit.timeit(legacy, number=number)
+        b = timeit.timeit(lambda: t.render(d), number=number)
+        print(f"{t.id:24s} format {a * 1e6 / number:7.2f}us  compiled {b * 1e6 / number:7.2f}us  x{a / b:.2f}")
+
+
+def bench_style(number: int = 5000) -> None:
+    text = dg.generate_document("complaint", {"事实与理由": "原告与被告于2020年签订买卖合同，约定被告按期交付货物，被告逾期未交付，经多次催告无果。" * 200}, "neutral")
+    for style in ["formal", "strict", "neutral"]:
+        t = timeit.timeit(lambda: dg._apply_style(text, style), number=number)
+        print(f"{style:8s} {len(text)} chars  {t * 1e6 / number:8.2f}us")
+
+
+def main():
+    bench_render()
+    bench_style()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,23 @@
-from dataclasses import dataclass
-from typing import Dict, List, Optional
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Tuple, Union
 from datetime import datetime
+from string import Formatter
 import re
 import json
 import os
 import random
 import urllib.request
+import threading
 import time
 import sys
+import hashlib
+import sqlite3
+import zlib
+import atexit
+import shutil
+import tempfile
+from contextlib import contextmanager
+from collections import OrderedDict
 
 
 @dataclass
@@ -18,6 +28,49 @@ class Template:
     fields: List[str]
     body: str
     styles: List[str]
+    # field -> static value, zero-arg provider (memoized per call) or Derived
+    defaults: Dict[str, Union[str, Callable[[], str], "Derived"]] = field(default_factory=dict)
+    segments: Optional[List[Tuple[str, Optional[str]]]] = field(default=None, init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        self.segments = _compile_body(self.body)
+
+    def render(self, data: Dict[str, str]) -> str:
+        if self.segments is None:
+            d = {f: "" for f in self.fields}
+            d.update(data)
+            return self.body.format(**d)
+        return _render_segments(self.segments, data)
+
+
+@dataclass(frozen=True)
+class Derived:
+    fn: Callable[[Dict[str, str]], Optional[str]]
+
+
+def _render_segments(segments: List[Tuple[str, Optional[str]]], data: Dict[str, str]) -> str:
+    out: List[str] = []
+    get = data.get
+    for lit, name in segments:
+        out.append(lit)
+        if name is not None:
+            v = get(name, "")
+            out.append(v if type(v) is str else format(v))
+    return "".join(out)
+
+
+def _compile_body(body: str) -> Optional[List[Tuple[str, Optional[str]]]]:
+    segs: List[Tuple[str, Optional[str]]] = []
+    try:
+        parsed = list(Formatter().parse(body))
+    except ValueError:
+        return None
+    for lit, name, spec, conv in parsed:
+        if name is not None and (spec or conv or not name.isidentifier()):
+            # Anything beyond a bare {field} goes through str.format
+            return None
+        segs.append((lit, name))
+    return segs
 
 
 def _today() -> str:
@@ -25,20 +78,207 @@ def _today() -> str:
 
 
 _TRAIN_FILE = "training_data.json"
+_TRAIN_LOG = "training_data.jsonl"
+_TRAIN_COUNTS_FILE = "training_counts.json"
+_TRAIN_META_FILE = "training_log_meta.json"
+_TRAIN_COMPACT_BYTES = 8 * 1024 * 1024
 _LEARNED_FILE = "learned_defaults.json"
 
 
+_path_locks: Dict[str, threading.RLock] = {}
+_path_locks_guard = threading.Lock()
+_held_locks = threading.local()
+
+
+@contextmanager
+def _file_lock(path: str):
+    # Exclusive lock on <path>.lock across threads and processes; re-entrant
+    # within a thread. The lock file is left in place on purpose.
+    key = os.path.abspath(path)
+    with _path_locks_guard:
+        lk = _path_locks.setdefault(key, threading.RLock())
+    with lk:
+        held = getattr(_held_locks, "paths", None)
+        if held is None:
+            held = _held_locks.paths = {}
+        if held.get(key):
+            held[key] += 1
+            try:
+                yield
+            finally:
+                held[key] -= 1
+            return
+        f = open(key + ".lock", "a+b")
+        try:
+            if os.name == "nt":
+                import msvcrt
+                f.seek(0)
+                while True:
+                    try:
+                        msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                        break
+                    except OSError:
+                        continue
+            else:
+                import fcntl
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            held[key] = 1
+            try:
+                yield
+            finally:
+                held[key] = 0
+                if os.name == "nt":
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+                else:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        finally:
+            f.close()
+
+
 def _load_json(path: str):
+    # Missing file -> {}. An unparsable file is copied to <path>.corrupt before
+    # returning {}, so the next save cannot silently destroy it.
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except Exception:
+        with open(path, "rb") as f:
+            raw = f.read()
+    except FileNotFoundError:
+        return {}
+    try:
+        # UnicodeDecodeError is a ValueError too: a non-UTF-8 file is corrupt
+        text = raw.decode("utf-8")
+        return json.loads(text) if text.strip() else {}
+    except ValueError:
+        bak = path + ".corrupt"
+        try:
+            shutil.copyfile(path, bak)
+        except OSError:
+            pass
+        print(f"警告：{path} 无法解析，已备份为 {bak}", file=sys.stderr)
         return {}
 
 
-def _save_json(path: str, obj):
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(obj, f, ensure_ascii=False, indent=2)
+def _replace(src: str, dst: str, attempts: int = 10) -> None:
+    # On Windows os.replace fails while a reader (which takes no lock) still
+    # has dst open; those reads are short, so retry briefly
+    for i in range(attempts):
+        try:
+            os.replace(src, dst)
+            return
+        except PermissionError:
+            if i == attempts - 1:
+                raise
+            time.sleep(0.02 * (i + 1))
+
+
+def _save_json(path: str, obj, indent: Optional[int] = 2):
+    # Serialize first, then temp file + fsync + os.replace under the file lock:
+    # readers see the old or the new file, never a truncated one
+    with _file_lock(path):
+        raw = json.dumps(obj, ensure_ascii=False, indent=indent, separators=None if indent else (",", ":"))
+        d = os.path.dirname(os.path.abspath(path))
+        fd, tmp = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp", dir=d)
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(raw)
+                f.flush()
+                os.fsync(f.fileno())
+            _replace(tmp, path)
+        except BaseException:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+
+
+# Snapshot files that are rewritten in bursts: the newest object per path is
+# written once, delay seconds after the first save, and at interpreter exit.
+class _CoalescedWriter:
+    def __init__(self, delay: float = 1.0):
+        self.delay = delay
+        self._pending: Dict[str, Tuple[object, Optional[int]]] = {}
+        self._lock = threading.Lock()
+        self._timer: Optional[threading.Timer] = None
+        self.saves = 0
+        self.writes = 0
+
+    def save(self, path: str, obj, indent: Optional[int] = 2) -> None:
+        with self._lock:
+            self._pending[os.path.abspath(path)] = (obj, indent)
+            self.saves += 1
+            if self._timer is None:
+                self._timer = threading.Timer(self.delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def pending(self, path: str):
+        with self._lock:
+            it = self._pending.get(os.path.abspath(path))
+        return it[0] if it else None
+
+    def flush(self) -> None:
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        for path, (obj, indent) in pending.items():
+            _save_json(path, obj, indent)
+            self.writes += 1
+
+
+_state_writer = _CoalescedWriter()
+atexit.register(_state_writer.flush)
+
+
+def flush_state() -> None:
+    _state_writer.flush()
+
+
+# A JSON file kept parsed in memory; reloaded when its mtime/size changes.
+class _JsonFileCache:
+    def __init__(self, path: str):
+        self.path = path
+        self._sig = None
+        self._obj = None
+        self.hits = 0
+        self.reloads = 0
+
+    def _signature(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (os.path.abspath(self.path), st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def get(self):
+        sig = self._signature()
+        if self._obj is not None and sig == self._sig:
+            self.hits += 1
+            return self._obj
+        self._obj = _load_json(self.path) if sig else {}
+        self._sig = sig
+        self.reloads += 1
+        return self._obj
+
+    def put(self, obj) -> None:
+        self._obj = obj
+        self._sig = self._signature()
+
+    def invalidate(self) -> None:
+        self._obj = None
+        self._sig = None
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "reloads": self.reloads}
+
+
+_learned_cache = _JsonFileCache(_LEARNED_FILE)
+
+
+def learned_defaults_stats() -> Dict[str, int]:
+    return _learned_cache.stats()
 
 
 def list_templates() -> List[Template]:
@@ -60,6 +300,12 @@ def list_templates() -> List[Template]:
             "日期：{日期}\n"
         ),
         styles=["formal", "neutral", "strict"],
+        defaults={
+            "法院名称": "××人民法院",
+            "诉讼请求": "请求依法判令被告承担相应民事责任",
+            "事实与理由": Derived(lambda r: f"因{r['案由']}引发纠纷，现依据相关法律提出诉讼" if r.get("案由") else None),
+            "原告性别": "男",
+        },
     )
     t2 = Template(
         id="contract",
@@ -79,6 +325,11 @@ def list_templates() -> List[Template]:
             "日期：{日期}\n"
         ),
         styles=["formal", "neutral"],
+        defaults={
+            "合同标题": Derived(lambda r: f"关于{r.get('合同标的') or '合作事宜'}之合同协议书"),
+            "争议解决": "双方协商不成的，提交甲方所在地人民法院处理",
+            "违约责任": "违约方应承担由此产生的全部损失",
+        },
     )
     t3 = Template(
         id="power_of_attorney",
@@ -96,6 +347,10 @@ def list_templates() -> List[Template]:
             "日期：{日期}\n"
         ),
         styles=["formal", "neutral", "strict"],
+        defaults={
+            "委托权限": "代为签署相关文件、递交材料、领取文书",
+            "委托期限": "自本委托书出具之日起至事项办理完毕",
+        },
     )
     t4 = Template(
         id="leave",
@@ -125,6 +380,13 @@ def list_templates() -> List[Template]:
             "申请日期：{申请日期}\n"
         ),
         styles=["formal", "neutral", "strict"],
+        defaults={
+            "申请日期": _today,
+            "请假类型": "事假",
+            "审批人": "直属主管",
+            "请假事由": "因个人事务需处理，特此请假",
+            "请假天数": "1",
+        },
     )
     t5 = Template(
         id="meeting_minutes",
@@ -145,6 +407,7 @@ def list_templates() -> List[Template]:
             "纪要日期：{日期}\n"
         ),
         styles=["formal", "neutral", "strict"],
+        defaults={"后续行动": "责任人明确，按计划推进，定期复盘"},
     )
     t6 = Template(
         id="recommendation_letter",
@@ -162,6 +425,7 @@ def list_templates() -> List[Template]:
             "日期：{日期}\n"
         ),
         styles=["formal", "neutral", "strict"],
+        defaults={"结语": "特此推荐，敬请审阅"},
     )
     t7 = Template(
         id="internship_application",
@@ -180,6 +444,7 @@ def list_templates() -> List[Template]:
             "日期：{日期}\n"
         ),
         styles=["formal", "neutral", "strict"],
+        defaults={"申请理由": "希望在实际场景中提升专业能力", "实习时间": "暑期两个月"},
     )
     t8 = Template(
         id="research_proposal",
@@ -199,6 +464,7 @@ def list_templates() -> List[Template]:
             "日期：{日期}\n"
         ),
         styles=["formal", "neutral", "strict"],
+        defaults={"时间安排": "分阶段实施：调研-设计-实验-总结"},
     )
     t11 = Template(
         id="project_proposal",
@@ -221,6 +487,7 @@ def list_templates() -> List[Template]:
             "日期：{日期}\n"
         ),
         styles=["formal", "neutral", "strict"],
+        defaults={"预期效益": "提升效率与质量，形成可复制经验"},
     )
     t12 = Template(
         id="data_analysis_report",
@@ -241,153 +508,340 @@ def list_templates() -> List[Template]:
             "日期：{日期}\n"
         ),
         styles=["formal", "neutral", "strict"],
+        defaults={"评估指标": "MAE、RMSE、AUC、F1等依任务选择"},
     )
     return [t1, t2, t3, t4, t5, t6, t7, t8, t11, t12]
 
 
-def _find_template(templates: List[Template], template_id: str) -> Optional[Template]:
-    for t in templates:
-        if t.id == template_id:
-            return t
-    return None
+# GB2312 level-1 hanzi are ordered by pinyin; these are the first codes of
+# each initial. Used when pypinyin is not installed.
+_GB_INITIALS = [
+    (0xB0A1, "a"), (0xB0C5, "b"), (0xB2C1, "c"), (0xB4EE, "d"), (0xB6EA, "e"),
+    (0xB7A2, "f"), (0xB8C1, "g"), (0xB9FE, "h"), (0xBBF7, "j"), (0xBFA6, "k"),
+    (0xC0AC, "l"), (0xC2E8, "m"), (0xC4C3, "n"), (0xC5B6, "o"), (0xC5BE, "p"),
+    (0xC6DA, "q"), (0xC8BB, "r"), (0xC8F6, "s"), (0xCBFA, "t"), (0xCDDA, "w"),
+    (0xCEF4, "x"), (0xD1B9, "y"), (0xD4D1, "z"),
+]
+
+
+def _gb_initial(ch: str) -> str:
+    if ch.isascii():
+        return ch.lower() if ch.isalnum() else ""
+    try:
+        b = ch.encode("gb2312")
+    except UnicodeEncodeError:
+        return ""
+    if len(b) != 2:
+        return ""
+    code = (b[0] << 8) | b[1]
+    if code < 0xB0A1 or code > 0xD7F9:
+        return ""
+    letter = ""
+    for start, x in _GB_INITIALS:
+        if code < start:
+            break
+        letter = x
+    return letter
+
+
+def pinyin_initials(text: str) -> str:
+    try:
+        from pypinyin import lazy_pinyin, Style
+    except Exception:
+        return "".join(_gb_initial(ch) for ch in text)
+    return "".join(x[:1].lower() for x in lazy_pinyin(text, style=Style.FIRST_LETTER) if x[:1].isalnum())
+
+
+class _TemplateSearch:
+    # Haystacks are built once per registry load; a query that extends the
+    # previous one from the same thread only rescans that thread's previous
+    # hits (the registry is shared by the GUI and the server).
+    def __init__(self, templates: List[Template]):
+        self._ids = [t.id for t in templates]
+        self._hay = []
+        self._heads = []
+        for t in templates:
+            words = [t.id, t.name, t.description] + list(t.fields)
+            inits = [pinyin_initials(x) for x in [t.name] + list(t.fields)]
+            self._hay.append("\n".join(words + inits).lower())
+            self._heads.append((t.id.lower(), t.name.lower(), inits[0]))
+        self._local = threading.local()
+
+    def search(self, query: str) -> List[str]:
+        q = " ".join((query or "").lower().split())
+        last = getattr(self._local, "last", None)
+        pool = last[1] if last and q.startswith(last[0]) else range(len(self._ids))
+        terms = q.split()
+        hits = [i for i in pool if all(x in self._hay[i] for x in terms)]
+        self._local.last = (q, hits)
+        if not terms:
+            return [self._ids[i] for i in hits]
+        # Templates whose id, name or name initials start with the query come first
+        head = terms[0]
+        ranked = sorted(hits, key=lambda i: not any(x.startswith(head) for x in self._heads[i]))
+        return [self._ids[i] for i in ranked]
+
+
+class TemplateRegistry:
+    def __init__(self, loader=list_templates):
+        self._loader = loader
+        self._by_id: Optional[Dict[str, Template]] = None
+        self._ordered: List[Template] = []
+        self._summaries: List[Dict[str, str]] = []
+        self._summary_by_id: Dict[str, Dict[str, str]] = {}
+        self._search: Optional[_TemplateSearch] = None
+
+    def reload(self) -> None:
+        ordered = list(self._loader())
+        self._summaries = [{"id": t.id, "name": t.name, "description": t.description} for t in ordered]
+        self._ordered = ordered
+        self._summary_by_id = {x["id"]: x for x in self._summaries}
+        self._search = _TemplateSearch(ordered)
+        self._by_id = {t.id: t for t in ordered}
+
+    def invalidate(self) -> None:
+        self._by_id = None
+
+    def _index(self) -> Dict[str, Template]:
+        idx = self._by_id
+        if idx is None:
+            self.reload()
+            idx = self._by_id
+        return idx
+
+    def get(self, template_id: str) -> Optional[Template]:
+        return self._index().get(template_id)
+
+    def all(self) -> List[Template]:
+        self._index()
+        return list(self._ordered)
+
+    def summaries(self) -> List[Dict[str, str]]:
+        self._index()
+        return list(self._summaries)
+
+    def search(self, query: str) -> List[Dict[str, str]]:
+        self._index()
+        by_id = self._summary_by_id
+        return [by_id[x] for x in self._search.search(query) if x in by_id]
+
+
+_registry = TemplateRegistry()
+
+
+def get_template(template_id: str) -> Optional[Template]:
+    return _registry.get(template_id)
+
+
+def reload_templates() -> None:
+    _registry.reload()
 
 
 def _smart_defaults(template: Template, data: Dict[str, str]) -> Dict[str, str]:
     r = dict(data)
+    memo: Dict[Callable, str] = {}
+
+    def provide(fn: Callable[[], str]) -> str:
+        v = memo.get(fn)
+        if v is None:
+            v = memo[fn] = fn()
+        return v
+
     if "日期" in template.fields and not r.get("日期"):
-        r["日期"] = _today()
-    learned = _load_json(_LEARNED_FILE)
+        r["日期"] = provide(_today)
+    learned = _learned_cache.get()
     ld = learned.get(template.id, {}) if isinstance(learned, dict) else {}
     for f in template.fields:
         if not r.get(f) and f in ld and isinstance(ld[f], str) and ld[f]:
             r[f] = ld[f]
-    if template.id == "complaint":
-        if not r.get("法院名称"):
-            r["法院名称"] = "××人民法院"
-        if not r.get("诉讼请求"):
-            r["诉讼请求"] = "请求依法判令被告承担相应民事责任"
-        if not r.get("事实与理由") and r.get("案由"):
-            r["事实与理由"] = f"因{r['案由']}引发纠纷，现依据相关法律提出诉讼"
-        if not r.get("原告性别"):
-            r["原告性别"] = "男"
-    if template.id == "contract":
-        if not r.get("合同标题"):
-            s = r.get("合同标的") or "合作事宜"
-            r["合同标题"] = f"关于{s}之合同协议书"
-        if not r.get("争议解决"):
-            r["争议解决"] = "双方协商不成的，提交甲方所在地人民法院处理"
-        if not r.get("违约责任"):
-            r["违约责任"] = "违约方应承担由此产生的全部损失"
-    if template.id == "power_of_attorney":
-        if not r.get("委托权限"):
-            r["委托权限"] = "代为签署相关文件、递交材料、领取文书"
-        if not r.get("委托期限"):
-            r["委托期限"] = "自本委托书出具之日起至事项办理完毕"
-    if template.id == "leave":
-        if not r.get("申请日期"):
-            r["申请日期"] = _today()
-        if not r.get("请假类型"):
-            r["请假类型"] = "事假"
-        if not r.get("审批人"):
-            r["审批人"] = "直属主管"
-        if not r.get("请假事由"):
-            r["请假事由"] = "因个人事务需处理，特此请假"
-        if not r.get("请假天数"):
-            r["请假天数"] = "1"
-    if template.id == "meeting_minutes":
-        if not r.get("日期"):
-            r["日期"] = _today()
-        if not r.get("后续行动"):
-            r["后续行动"] = "责任人明确，按计划推进，定期复盘"
-    if template.id == "recommendation_letter":
-        if not r.get("结语"):
-            r["结语"] = "特此推荐，敬请审阅"
-        if not r.get("日期"):
-            r["日期"] = _today()
-    if template.id == "internship_application":
-        if not r.get("申请理由"):
-            r["申请理由"] = "希望在实际场景中提升专业能力"
-        if not r.get("实习时间"):
-            r["实习时间"] = "暑期两个月"
-        if not r.get("日期"):
-            r["日期"] = _today()
-    if template.id == "research_proposal":
-        if not r.get("时间安排"):
-            r["时间安排"] = "分阶段实施：调研-设计-实验-总结"
-        if not r.get("日期"):
-            r["日期"] = _today()
-    if template.id == "project_proposal":
-        if not r.get("预期效益"):
-            r["预期效益"] = "提升效率与质量，形成可复制经验"
-        if not r.get("日期"):
-            r["日期"] = _today()
-    if template.id == "data_analysis_report":
-        if not r.get("评估指标"):
-            r["评估指标"] = "MAE、RMSE、AUC、F1等依任务选择"
-        if not r.get("日期"):
-            r["日期"] = _today()
+    for f, dv in template.defaults.items():
+        if r.get(f):
+            continue
+        if isinstance(dv, str):
+            v = dv
+        elif isinstance(dv, Derived):
+            v = dv.fn(r)
+        else:
+            v = provide(dv)
+        if v:
+            r[f] = v
     return r
 
 
-def _apply_style(text: str, style: str) -> str:
-    if style not in {"formal", "neutral", "strict"}:
-        return text
-    rules = []
-    if style == "formal":
-        rules = [
-            (r"(?<!诉讼)请求(?!：)", "恳请"),
-            (r"依据", "依照"),
-            (r"提交", "谨此提交"),
-            (r"违约", "违约行为"),
-            (r"处理", "审理处理"),
-        ]
-        for pat, rep in rules:
-            text = re.sub(pat, rep, text)
-        reason = None
-        m1 = re.search(r"案由：(.+?)。", text)
-        if m1:
-            reason = m1.group(1)
-        m2 = re.search(r"请假事由：(.+?)\n", text)
-        if not reason and m2:
-            reason = m2.group(1)
-        if "民事起诉状" in text:
-            pre = f"兹因{reason or '相关纠纷'}，谨此呈请贵院审理。\n\n"
-            text = re.sub(r"^(民事起诉状\s*\n+)", r"\1" + pre, text)
-        elif "合同协议书" in text:
-            pre = "为明确双方权利义务，特订立本协议。\n\n"
-            text = re.sub(r"^(合同协议书\s*\n+)", r"\1" + pre, text)
-        elif "授权委托书" in text:
-            pre = "兹委托受托人依法办理相关事宜。\n\n"
-            text = re.sub(r"^(授权委托书\s*\n+)", r"\1" + pre, text)
-        elif "请假申请" in text:
-            pre = f"兹因{reason or '个人事务'}需处理，谨此申请请假。\n\n"
-            text = re.sub(r"^(请假申请\s*\n+)", r"\1" + pre, text)
-        return text
-    if style == "strict":
-        rules = [
-            (r"(?<!诉讼)请求(?!：)", "特此请求"),
-            (r"依据", "依法律规定"),
-            (r"事实与理由：", "事实与法律依据："),
-            (r"诉讼请求：", "请求事项："),
-            (r"委托事项：", "委托事宜："),
-            (r"请假事由：", "事由："),
-        ]
-        for pat, rep in rules:
-            text = re.sub(pat, rep, text)
-        if "民事起诉状" in text:
-            pre = "经查明，现依法提出如下请求。\n\n"
-            text = re.sub(r"^(民事起诉状\s*\n+)", r"\1" + pre, text)
-        elif "合同协议书" in text:
-            pre = "为规范履约，双方特约如下条款。\n\n"
-            text = re.sub(r"^(合同协议书\s*\n+)", r"\1" + pre, text)
-        elif "授权委托书" in text:
-            pre = "特此授权，受托人按本委托行事。\n\n"
-            text = re.sub(r"^(授权委托书\s*\n+)", r"\1" + pre, text)
-        elif "请假申请" in text:
-            pre = "现依制度申请请假如下。\n\n"
-            text = re.sub(r"^(请假申请\s*\n+)", r"\1" + pre, text)
+_STYLE_FILE = "styles.json"
+_HOUSE_STYLE_FILE = "house_styles.json"
+_LOOKAROUND_RE = re.compile(r"\(\?<?[=!](?:\\.|[^()\\])*\)")
+
+
+def _literal_key(pat: str) -> Optional[str]:
+    # The text a rule matches when it is a literal guarded only by lookarounds
+    core = _LOOKAROUND_RE.sub("", pat)
+    lit = re.sub(r"\\(.)", r"\1", core)
+    return lit if lit and re.escape(lit) == core else None
+
+
+# A style's rules folded into one alternation and applied in a single scan.
+# Literal rules dispatch on the matched text so the alternation needs no
+# capturing groups and re can keep its literal-prefix search; patterns should
+# open with a literal for the same reason.
+class _CompiledStyle:
+    def __init__(self, rules: List[Tuple[str, str]], preambles: Optional[Dict[str, Dict]] = None):
+        self.pattern = None
+        self.table: Dict = {}
+        self.by_group = False
+        keys = [_literal_key(pat) for pat, _ in rules]
+        if rules and None not in keys and len(set(keys)) == len(keys):
+            self.pattern = re.compile("|".join(f"(?:{pat})" for pat, _ in rules))
+            self.table = {k: rep for k, (_, rep) in zip(keys, rules)}
+        elif rules:
+            gi = 1
+            for pat, rep in rules:
+                self.table[gi] = rep
+                gi += 1 + re.compile(pat).groups
+            self.pattern = re.compile("|".join(f"({pat})" for pat, _ in rules))
+            self.by_group = True
+        # Preambles are keyed by template id and go after the heading: the
+        # line named by "after" (only when the text starts with it) or else
+        # the first line. "capture" fills a placeholder from the styled text
+        # (first matching pattern wins).
+        self.preambles: Dict[str, Tuple] = {}
+        for tid, p in (preambles or {}).items():
+            after = p.get("after")
+            head = re.compile(r"\A" + re.escape(after) + r"\s*\n+") if after else re.compile(r"\A[^\n]*\s*\n+")
+            capture = {k: [re.compile(x) for x in v] for k, v in (p.get("capture") or {}).items()}
+            self.preambles[tid] = (head, _compile_body(p.get("text", "")), p.get("defaults") or {}, capture)
+
+    def _dispatch(self, m) -> str:
+        if self.by_group:
+            return self.table[m.lastindex]
+        return self.table[m.group()]
+
+    def rewrite(self, text: str) -> str:
+        if self.pattern is None or not text:
+            return text
+        return self.pattern.sub(self._dispatch, text)
+
+    def apply(self, text: str, template_id: Optional[str] = None, data: Optional[Dict[str, str]] = None) -> str:
+        text = self.rewrite(text)
+        p = self.preambles.get(template_id) if template_id else None
+        if p is None:
+            return text
+        head, segs, defaults, capture = p
+        m = head.search(text)
+        if not m or segs is None:
+            return text
+        vals: Dict[str, str] = {}
+        for _, name in segs:
+            if name is None:
+                continue
+            if name in capture:
+                v = next((cm.group(1) for cm in (rx.search(text) for rx in capture[name]) if cm), "")
+                vals[name] = v or defaults.get(name, "")
+                continue
+            v = (data or {}).get(name)
+            v = (v if type(v) is str else format(v)).strip().split("\n", 1)[0] if v else ""
+            vals[name] = self.rewrite(v or defaults.get(name, ""))
+        return text[:m.end()] + _render_segments(segs, vals) + "\n\n" + text[m.end():]
+
+
+# Used when styles.json cannot be read (e.g. a build that did not bundle it);
+# keep in sync with styles.json
+_BUILTIN_STYLES: Dict[str, Dict] = {
+    "formal": {
+        "rules": [
+            ["请(?<!诉讼请)求(?!：)", "恳请"],
+            ["依据", "依照"],
+            ["提交", "谨此提交"],
+            ["违约", "违约行为"],
+            ["处理", "审理处理"],
+        ],
+        "preambles": {
+            "complaint": {
+                "after": "民事起诉状",
+                "text": "兹因{案由}，谨此呈请贵院审理。",
+                "capture": {"案由": ["案由：(.+?)。", "请假事由：(.+?)\n"]},
+                "defaults": {"案由": "相关纠纷"},
+            },
+            "contract": {"after": "合同协议书", "text": "为明确双方权利义务，特订立本协议。"},
+            "power_of_attorney": {"after": "授权委托书", "text": "兹委托受托人依法办理相关事宜。"},
+            "leave": {
+                "after": "请假申请",
+                "text": "兹因{事由}需处理，谨此申请请假。",
+                "capture": {"事由": ["案由：(.+?)。", "请假事由：(.+?)\n"]},
+                "defaults": {"事由": "个人事务"},
+            },
+        },
+    },
+    "neutral": {"rules": [], "preambles": {}},
+    "strict": {
+        "rules": [
+            ["请(?<!诉讼请)求(?!：)", "特此请求"],
+            ["依据", "依法律规定"],
+            ["事实与理由：", "事实与法律依据："],
+            ["诉讼请求：", "请求事项："],
+            ["委托事项：", "委托事宜："],
+            ["请假事由：", "事由："],
+        ],
+        "preambles": {
+            "complaint": {"after": "民事起诉状", "text": "经查明，现依法提出如下请求。"},
+            "contract": {"after": "合同协议书", "text": "为规范履约，双方特约如下条款。"},
+            "power_of_attorney": {"after": "授权委托书", "text": "特此授权，受托人按本委托行事。"},
+            "leave": {"after": "请假申请", "text": "现依制度申请请假如下。"},
+        },
+    },
+}
+
+_styles: Optional[Dict[str, _CompiledStyle]] = None
+
+
+def _compile_styles(cfg) -> Dict[str, _CompiledStyle]:
+    out: Dict[str, _CompiledStyle] = {}
+    if not isinstance(cfg, dict):
+        return out
+    for name, spec in cfg.items():
+        if isinstance(spec, dict):
+            rules = [(pat, rep) for pat, rep in spec.get("rules", [])]
+            out[name] = _CompiledStyle(rules, spec.get("preambles"))
+    return out
+
+
+def _read_style_file(path: str) -> Dict[str, _CompiledStyle]:
+    return _compile_styles(_load_json(path))
+
+
+def _style_table() -> Dict[str, _CompiledStyle]:
+    global _styles
+    if _styles is None:
+        table = _read_style_file(os.path.join(_resource_base(), _STYLE_FILE)) or _compile_styles(_BUILTIN_STYLES)
+        table.update(_read_style_file(_HOUSE_STYLE_FILE))
+        _styles = table
+    return _styles
+
+
+def load_styles(path: str) -> List[str]:
+    table = _read_style_file(path)
+    _style_table().update(table)
+    return list(table)
+
+
+def register_style(name: str, rules: List[Tuple[str, str]], preambles: Optional[Dict[str, Dict]] = None) -> None:
+    _style_table()[name] = _CompiledStyle(list(rules), preambles)
+
+
+def reload_styles() -> None:
+    global _styles
+    _styles = None
+
+
+def style_names() -> List[str]:
+    return list(_style_table())
+
+
+def _apply_style(text: str, style: str, template_id: Optional[str] = None, data: Optional[Dict[str, str]] = None) -> str:
+    cs = _style_table().get(style)
+    if cs is None:
         return text
-    return text
+    return cs.apply(text, template_id, data)
 
 
 def _normalize(text: str) -> str:
@@ -398,16 +852,12 @@ def _normalize(text: str) -> str:
 
 
 def generate_document(template_id: str, data: Dict[str, str], style: str = "formal") -> str:
-    templates = list_templates()
-    t = _find_template(templates, template_id)
+    t = _registry.get(template_id)
     if not t:
         raise ValueError("模板不存在")
     d = _smart_defaults(t, data)
-    missing = [f for f in t.fields if f not in d]
-    for k in missing:
-        d[k] = ""
-    text = t.body.format(**d)
-    text = _apply_style(text, style)
+    text = t.render(d)
+    text = _apply_style(text, style, t.id, d)
     return _normalize(text)
 
 
@@ -416,127 +866,327 @@ def render_preview(template_id: str, data: Dict[str, str], style: str = "formal"
 
 
 def template_fields(template_id: str) -> List[str]:
-    t = _find_template(list_templates(), template_id)
+    t = _registry.get(template_id)
     if not t:
         return []
-    return t.fields
+    return list(t.fields)
 
 
 def template_list() -> List[Dict[str, str]]:
-    items = []
-    for t in list_templates():
-        items.append({"id": t.id, "name": t.name, "description": t.description})
-    return items
+    return _registry.summaries()
+
+
+def search_templates(query: str) -> List[Dict[str, str]]:
+    # Matches id, name, description, field names and pinyin initials of the
+    # name and fields (e.g. "qjsq" finds 请假申请); every space-separated term must hit
+    return _registry.search(query)
+
+
+def _migrate_training_file() -> None:
+    # One-off move of a legacy {"rows": [...]} store into the append-only log
+    if not os.path.exists(_TRAIN_FILE):
+        return
+    with _file_lock(_TRAIN_LOG):
+        if os.path.exists(_TRAIN_FILE):
+            _migrate_training_file_locked()
+
+
+def _migrate_training_file_locked() -> None:
+    store = _load_json(_TRAIN_FILE)
+    rows = store.get("rows", []) if isinstance(store, dict) else []
+    tmp = _TRAIN_LOG + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as out:
+        for r in rows:
+            if isinstance(r, dict):
+                out.write(json.dumps(r, ensure_ascii=False, separators=(",", ":")) + "\n")
+        if os.path.exists(_TRAIN_LOG):
+            with open(_TRAIN_LOG, "r", encoding="utf-8") as f:
+                for line in f:
+                    out.write(line if line.endswith("\n") else line + "\n")
+    os.replace(tmp, _TRAIN_LOG)
+    os.replace(_TRAIN_FILE, _TRAIN_FILE + ".bak")
+
+
+def _iter_training_rows():
+    _migrate_training_file()
+    try:
+        f = open(_TRAIN_LOG, "r", encoding="utf-8")
+    except OSError:
+        return
+    with f:
+        for line in f:
+            try:
+                r = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(r, dict):
+                yield r
+
+
+def _compacted_size() -> int:
+    # Size of the log right after its last compaction, shared by every process
+    # through a sidecar; it only applies while the log is that same file
+    meta = _load_json(_TRAIN_META_FILE)
+    try:
+        ino = os.stat(_TRAIN_LOG).st_ino
+    except OSError:
+        return 0
+    if isinstance(meta, dict) and meta.get("ino") == ino:
+        return int(meta.get("size") or 0)
+    return 0
+
+
+def _append_training_rows(rows) -> int:
+    _migrate_training_file()
+    n = 0
+    buf: List[str] = []
+    # Held across the append and a possible compaction, so a concurrent
+    # compaction cannot replace the log under rows being written
+    with _file_lock(_TRAIN_LOG):
+        with open(_TRAIN_LOG, "a", encoding="utf-8") as f:
+            for r in rows:
+                buf.append(json.dumps(r, ensure_ascii=False, separators=(",", ":")) + "\n")
+                if len(buf) >= 4096:
+                    f.write("".join(buf))
+                    n += len(buf)
+                    buf = []
+            if buf:
+                f.write("".join(buf))
+                n += len(buf)
+            f.flush()
+            os.fsync(f.fileno())
+        if not n:
+            return 0
+        try:
+            size = os.path.getsize(_TRAIN_LOG)
+        except OSError:
+            return n
+        if size > max(_TRAIN_COMPACT_BYTES, 2 * _compacted_size()):
+            compact_training_log()
+    return n
+
+
+def compact_training_log() -> int:
+    # Collapse repeated (template, field, value) rows into one counted row,
+    # keeping first-seen order so ties in run_training resolve as before
+    with _file_lock(_TRAIN_LOG):
+        return _compact_training_log_locked()
+
+
+def _compact_training_log_locked() -> int:
+    merged: Dict[Tuple[str, str, str], Dict] = {}
+    for r in _iter_training_rows():
+        tid, f, v = r.get("template_id"), r.get("field"), r.get("value")
+        if not tid or not f or not v:
+            continue
+        k = (tid, f, v)
+        m = merged.get(k)
+        if m is None:
+            merged[k] = m = {"template_id": tid, "field": f, "value": v, "n": 0}
+        m["n"] += int(r.get("n", 1))
+        if r.get("ts"):
+            m["ts"] = max(m.get("ts", 0), r["ts"])
+    tmp = _TRAIN_LOG + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as out:
+        for m in merged.values():
+            out.write(json.dumps(m, ensure_ascii=False, separators=(",", ":")) + "\n")
+        out.flush()
+        os.fsync(out.fileno())
+    os.replace(tmp, _TRAIN_LOG)
+    st = os.stat(_TRAIN_LOG)
+    _save_json(_TRAIN_META_FILE, {"ino": st.st_ino, "size": st.st_size})
+    return len(merged)
 
 
 def record_training(template_id: str, data: Dict[str, str]):
-    t = _find_template(list_templates(), template_id)
+    t = _registry.get(template_id)
     if not t:
         return
     rows = []
+    ts = int(time.time())
     for f in t.fields:
         v = (data.get(f) or "").strip()
         if v:
-            rows.append({"template_id": template_id, "field": f, "value": v})
-    store = _load_json(_TRAIN_FILE)
-    if not isinstance(store, dict):
-        store = {}
-    lst = store.get("rows", [])
-    if not isinstance(lst, list):
-        lst = []
-    lst.extend(rows)
-    store["rows"] = lst
-    _save_json(_TRAIN_FILE, store)
+            rows.append({"template_id": template_id, "field": f, "value": v, "ts": ts})
+    if rows:
+        _append_training_rows(rows)
 
 
-def run_training() -> Dict[str, Dict[str, str]]:
-    store = _load_json(_TRAIN_FILE)
-    rows = store.get("rows", []) if isinstance(store, dict) else []
-    result: Dict[str, Dict[str, str]] = {}
-    counts: Dict[str, Dict[str, Dict[str, int]]] = {}
+def _read_new_training_rows(offset: int):
+    # Complete lines appended to the log since offset, and the offset after them
+    rows: List[Dict] = []
+    try:
+        with open(_TRAIN_LOG, "rb") as f:
+            f.seek(offset)
+            chunk = f.read()
+    except OSError:
+        return rows, offset
+    end = chunk.rfind(b"\n") + 1
+    for line in chunk[:end].splitlines():
+        try:
+            r = json.loads(line.decode("utf-8"))
+        except ValueError:
+            continue
+        if isinstance(r, dict):
+            rows.append(r)
+    return rows, offset + end
+
+
+def _load_training_counts() -> Dict:
+    state = _state_writer.pending(_TRAIN_COUNTS_FILE)
+    if state is None:
+        state = _load_json(_TRAIN_COUNTS_FILE)
+    if not isinstance(state, dict) or not isinstance(state.get("counts"), dict):
+        state = {"counts": {}, "modes": {}, "seq": 0, "offset": 0}
+    try:
+        st = os.stat(_TRAIN_LOG)
+        ino, size = st.st_ino, st.st_size
+    except OSError:
+        ino, size = None, 0
+    # A replaced (migrated/compacted) or truncated log is recounted from the start
+    if state.get("ino") != ino or state.get("offset", 0) > size:
+        state = {"counts": {}, "modes": {}, "seq": 0, "offset": 0}
+    state["ino"] = ino
+    return state
+
+
+def _update_training_counts(state: Dict) -> int:
+    rows, state["offset"] = _read_new_training_rows(state.get("offset", 0))
+    counts = state["counts"]
+    modes = state.setdefault("modes", {})
+    seq = state.get("seq", 0)
     for r in rows:
         tid = r.get("template_id")
         f = r.get("field")
         v = r.get("value")
         if not tid or not f or not v:
             continue
-        counts.setdefault(tid, {}).setdefault(f, {}).setdefault(v, 0)
-        counts[tid][f][v] += 1
-    for tid, fd in counts.items():
-        result.setdefault(tid, {})
-        for f, cdict in fd.items():
-            best = None
-            freq = -1
-            for v, n in cdict.items():
-                if n > freq:
-                    best = v
-                    freq = n
-            if best:
-                result[tid][f] = best
-    _save_json(_LEARNED_FILE, result)
+        c = counts.setdefault(tid, {}).setdefault(f, {})
+        e = c.get(v)
+        if e is None:
+            e = c[v] = [0, 0, seq]
+            seq += 1
+        e[0] += int(r.get("n", 1))
+        e[1] = max(e[1], int(r.get("ts", 0)))
+        # Same winner as a full argmax: highest count, earliest first-seen on ties
+        best = modes.setdefault(tid, {}).get(f)
+        b = c.get(best) if best is not None else None
+        if b is None or e[0] > b[0] or (e[0] == b[0] and e[2] < b[2]):
+            modes[tid][f] = v
+    state["seq"] = seq
+    return len(rows)
+
+
+def _decayed(e: List[int], now: float, half_life_days: Optional[float]) -> float:
+    if not half_life_days:
+        return e[0]
+    age = max(0.0, now - e[1]) / 86400.0
+    return e[0] * 0.5 ** (age / half_life_days)
+
+
+def _top_values(state: Dict, k: int, half_life_days: Optional[float]) -> Dict[str, Dict[str, List[str]]]:
+    now = time.time()
+    out: Dict[str, Dict[str, List[str]]] = {}
+    for tid, fd in state["counts"].items():
+        for f, c in fd.items():
+            ranked = sorted(c.items(), key=lambda kv: (-_decayed(kv[1], now, half_life_days), kv[1][2]))
+            out.setdefault(tid, {})[f] = [v for v, _ in ranked[:k]]
+    return out
+
+
+def training_top_values(k: int = 3, half_life_days: Optional[float] = None) -> Dict[str, Dict[str, List[str]]]:
+    _migrate_training_file()
+    with _file_lock(_TRAIN_COUNTS_FILE):
+        state = _load_training_counts()
+        _update_training_counts(state)
+        _state_writer.save(_TRAIN_COUNTS_FILE, state, indent=None)
+        return _top_values(state, k, half_life_days)
+
+
+def run_training(half_life_days: Optional[float] = None) -> Dict[str, Dict[str, str]]:
+    _migrate_training_file()
+    with _file_lock(_TRAIN_COUNTS_FILE):
+        state = _load_training_counts()
+        _update_training_counts(state)
+        if half_life_days:
+            result = {tid: {f: vs[0] for f, vs in fd.items()} for tid, fd in _top_values(state, 1, half_life_days).items()}
+        else:
+            result = {tid: dict(fd) for tid, fd in state["modes"].items()}
+        _state_writer.save(_TRAIN_COUNTS_FILE, state, indent=None)
+    if result != _learned_cache.get() or not os.path.exists(_LEARNED_FILE):
+        _save_json(_LEARNED_FILE, result)
+        _learned_cache.put(result)
     return result
 
 
-def _rand_name() -> str:
-    xs = ["张三", "李四", "王五", "赵六", "孙七", "周八", "吴九", "郑十", "钱一", "刘二"]
-    return random.choice(xs)
-
-
-def _rand_org() -> str:
-    xs = ["××大学", "××公司", "××研究院", "××实验室"]
-    return random.choice(xs)
-
-
-def _rand_text(kind: str) -> str:
-    base = {
-        "案由": ["合同纠纷", "劳动争议", "侵权纠纷"],
-        "诉讼请求": ["请求承担损失", "请求返还款项", "请求解除合同"],
-        "请假类型": ["事假", "病假", "年休假"],
-        "部门": ["研发部", "市场部", "人事部"],
-        "会议地点": ["会议室A", "会议室B", "线上会议"],
-        "主持人": ["主持人甲", "主持人乙"],
-        "学校与专业": ["××大学计算机", "××学院数据科学", "××大学电子信息"],
-        "实习岗位": ["数据分析", "算法工程", "前端开发"],
-        "实习单位": ["××科技", "××互联网", "××制造"],
-        "经费预算": ["5万", "10万", "20万"],
-        "评估指标": ["MAE", "RMSE", "F1"],
-    }
-    xs = base.get(kind)
-    if xs:
-        return random.choice(xs)
-    return f"示例{kind}"
+_RAND_NAMES = ["张三", "李四", "王五", "赵六", "孙七", "周八", "吴九", "郑十", "钱一", "刘二"]
+_RAND_ORGS = ["××大学", "××公司", "××研究院", "××实验室"]
+_RAND_TEXTS = {
+    "案由": ["合同纠纷", "劳动争议", "侵权纠纷"],
+    "诉讼请求": ["请求承担损失", "请求返还款项", "请求解除合同"],
+    "请假类型": ["事假", "病假", "年休假"],
+    "部门": ["研发部", "市场部", "人事部"],
+    "会议地点": ["会议室A", "会议室B", "线上会议"],
+    "主持人": ["主持人甲", "主持人乙"],
+    "学校与专业": ["××大学计算机", "××学院数据科学", "××大学电子信息"],
+    "实习岗位": ["数据分析", "算法工程", "前端开发"],
+    "实习单位": ["××科技", "××互联网", "××制造"],
+    "经费预算": ["5万", "10万", "20万"],
+    "评估指标": ["MAE", "RMSE", "F1"],
+}
+_NAME_FIELDS = {"原告姓名", "被告姓名", "委托人姓名", "受托人姓名", "申请人姓名", "负责人", "推荐人姓名", "被推荐人姓名"}
+_ORG_FIELDS = {"甲方名称", "乙方名称", "推荐人单位"}
+
+
+def _synthetic_choices(f: str, today: str) -> List[str]:
+    if f in _NAME_FIELDS:
+        return _RAND_NAMES
+    if f == "原告性别":
+        return ["男", "女"]
+    if f in _ORG_FIELDS:
+        return _RAND_ORGS
+    if f == "法院名称":
+        return ["××人民法院"]
+    if f in {"日期", "申请日期"}:
+        return [today]
+    return _RAND_TEXTS.get(f) or [f"示例{f}"]
+
+
+def _synthetic_rows(per_template: int, rng: random.Random, block: int = 65536):
+    # Draws are taken a column at a time and written as counted rows (see
+    # compact_training_log); first-seen order is kept for run_training's ties
+    today = _today()
+    ts = int(time.time())
+    for t in _registry.all():
+        counts: Dict[str, Dict[str, int]] = {f: {} for f in t.fields}
+        done = 0
+        while done < per_template:
+            k = min(block, per_template - done)
+            for f in t.fields:
+                c = counts[f]
+                for v in rng.choices(_synthetic_choices(f, today), k=k):
+                    c[v] = c.get(v, 0) + 1
+            done += k
+        for f in t.fields:
+            for v, n in counts[f].items():
+                yield {"template_id": t.id, "field": f, "value": v, "n": n, "ts": ts}
 
 
-def synthesize_training_data(per_template: int = 20) -> int:
-    cnt = 0
-    for t in list_templates():
-        for _ in range(per_template):
-            data: Dict[str, str] = {}
-            for f in t.fields:
-                if f in {"原告姓名", "被告姓名", "委托人姓名", "受托人姓名", "申请人姓名", "负责人", "推荐人姓名", "被推荐人姓名"}:
-                    data[f] = _rand_name()
-                elif f in {"原告性别"}:
-                    data[f] = random.choice(["男", "女"])
-                elif f in {"甲方名称", "乙方名称", "推荐人单位"}:
-                    data[f] = _rand_org()
-                elif f in {"法院名称"}:
-                    data[f] = "××人民法院"
-                elif f in {"日期", "申请日期"}:
-                    data[f] = _today()
-                else:
-                    data[f] = _rand_text(f)
-            record_training(t.id, data)
-            cnt += 1
-    return cnt
+def synthesize_training_data(per_template: int = 20, seed: Optional[int] = None) -> int:
+    rng = random.Random(seed)
+    _append_training_rows(_synthetic_rows(per_template, rng))
+    return per_template * len(_registry.all())
 
 
-def auto_train(per_template: int = 20) -> Dict[str, Dict[str, str]]:
-    synthesize_training_data(per_template)
+def auto_train(per_template: int = 20, seed: Optional[int] = None) -> Dict[str, Dict[str, str]]:
+    synthesize_training_data(per_template, seed)
     return run_training()
 
 
 _HW_STYLE_FILE = "handwrite_style.json"
 _HISTORY_FILE = "history.json"
+_HISTORY_DB = "history.db"
+_HW_CACHE_DIR = "handwrite_cache"
 
 
 def _resource_base() -> str:
@@ -592,6 +1242,8 @@ def ensure_handwrite_assets() -> List[str]:
                     pass
             if os.path.exists(p):
                 paths.append(p)
+        if paths:
+            refresh_font_table()
     return paths
 
 def _win_fonts_dir() -> str:
@@ -605,194 +1257,836 @@ def _mac_fonts_dirs() -> List[str]:
         os.path.join(homes, "Library", "Fonts"),
     ]
 
-def resolve_font_by_name(name: str) -> Optional[str]:
-    nm = (name or "").strip().lower()
+_FONT_ALIASES = {
+    "宋体": {"宋体", "song", "simsun"},
+    "楷体": {"楷体", "kaiti", "simkai"},
+    "黑体": {"黑体", "hei", "simhei"},
+    "手写-马善政": {"手写-马善政"},
+    "手写-芝蔓行": {"手写-芝蔓行"},
+    "手写-龙藏": {"手写-龙藏"},
+}
+_FONT_BY_ALIAS = {a: k for k, names in _FONT_ALIASES.items() for a in names}
+
+
+def _linux_fonts_dirs() -> List[str]:
+    homes = os.path.expanduser("~")
+    dirs = [
+        "/usr/share/fonts",
+        "/usr/local/share/fonts",
+        os.path.join(homes, ".local", "share", "fonts"),
+        os.path.join(homes, ".fonts"),
+    ]
+    xdg = os.environ.get("XDG_DATA_HOME")
+    if xdg:
+        dirs.append(os.path.join(xdg, "fonts"))
+    return dirs
+
+
+_system_fonts: Optional[Dict[str, str]] = None
+
+
+def _system_font_files() -> Dict[str, str]:
+    # fontconfig-style directories are nested, so index them by file name once
+    global _system_fonts
+    if _system_fonts is None:
+        found: Dict[str, str] = {}
+        for base in _linux_fonts_dirs():
+            for root, dirs, files in os.walk(base):
+                dirs.sort()
+                for fn in sorted(files):
+                    found.setdefault(fn.lower(), os.path.join(root, fn))
+        _system_fonts = found
+    return _system_fonts
+
+
+# Family names to pick out of a collection, best first
+_FONT_FAMILIES = {
+    "宋体": ["SimSun", "Songti SC", "STSong", "Noto Serif CJK SC", "Source Han Serif SC", "AR PL UMing CN"],
+    "楷体": ["KaiTi", "Kaiti SC", "STKaiti", "AR PL UKai CN", "AR PL KaitiM GB"],
+    "黑体": ["SimHei", "Heiti SC", "STHeiti", "PingFang SC", "Noto Sans CJK SC", "Source Han Sans SC", "WenQuanYi Zen Hei", "WenQuanYi Micro Hei"],
+}
+
+
+def _font_candidates(name: str) -> List[str]:
     d = _win_fonts_dir()
-    if nm in {"宋体", "song", "simsun"}:
-        p = os.path.join(d, "simsun.ttc")
-        if os.path.exists(p):
-            return p
-        # Fallback to SimHei if SimSun TTC not available
-        p2 = os.path.join(d, "simhei.ttf")
-        return p2 if os.path.exists(p2) else None
-    if nm in {"楷体", "kaiti", "simkai"}:
-        p = os.path.join(d, "simkai.ttf")
-        return p if os.path.exists(p) else None
-    if nm in {"黑体", "hei", "simhei"}:
-        p = os.path.join(d, "simhei.ttf")
-        return p if os.path.exists(p) else None
-    if nm in {"手写-马善政"}:
-        p = os.path.join(_fonts_dir(), "MaShanZheng-Regular.ttf")
-        return p if os.path.exists(p) else None
-    if nm in {"手写-芝蔓行"}:
-        p = os.path.join(_fonts_dir(), "ZhiMangXing-Regular.ttf")
-        return p if os.path.exists(p) else None
-    if nm in {"手写-龙藏"}:
-        p = os.path.join(_fonts_dir(), "LongCang-Regular.ttf")
-        return p if os.path.exists(p) else None
-    # macOS candidates
+    bundled = {
+        "手写-马善政": "MaShanZheng-Regular.ttf",
+        "手写-芝蔓行": "ZhiMangXing-Regular.ttf",
+        "手写-龙藏": "LongCang-Regular.ttf",
+    }
+    if name in bundled:
+        return [os.path.join(_fonts_dir(), bundled[name])]
+    win = {
+        # SimHei stands in when the SimSun TTC is not available
+        "宋体": ["simsun.ttc", "simhei.ttf"],
+        "楷体": ["simkai.ttf"],
+        "黑体": ["simhei.ttf"],
+    }
+    mac = {
+        "宋体": ["Songti.ttc", "STSong.ttf", "STSongti-SC-Regular.otf", "PingFang.ttc"],
+        "楷体": ["Kaiti.ttc", "STKaiti.ttf", "STKaiti-SC-Regular.otf"],
+        "黑体": ["STHeiti Light.ttc", "PingFang.ttc", "Heiti.ttc"],
+    }
+    linux = {
+        "宋体": ["NotoSerifCJK-Regular.ttc", "NotoSerifCJKsc-Regular.otf", "SourceHanSerif-Regular.ttc", "SourceHanSerifSC-Regular.otf", "uming.ttc"],
+        "楷体": ["ukai.ttc", "gkai00mp.ttf"],
+        "黑体": ["NotoSansCJK-Regular.ttc", "NotoSansCJKsc-Regular.otf", "SourceHanSans-Regular.ttc", "SourceHanSansSC-Regular.otf", "wqy-zenhei.ttc", "wqy-microhei.ttc"],
+    }
+    cands = [os.path.join(d, fn) for fn in win.get(name, [])]
     if sys.platform == "darwin":
-        cands: List[str] = []
-        if nm in {"宋体", "song", "simsun"}:
-            cands = [
-                "Songti.ttc",
-                "STSong.ttf",
-                "STSongti-SC-Regular.otf",
-                "PingFang.ttc",
-            ]
-        elif nm in {"楷体", "kaiti", "simkai"}:
-            cands = [
-                "Kaiti.ttc",
-                "STKaiti.ttf",
-                "STKaiti-SC-Regular.otf",
-            ]
-        elif nm in {"黑体", "hei", "simhei"}:
-            cands = [
-                "STHeiti Light.ttc",
-                "PingFang.ttc",
-                "Heiti.ttc",
-            ]
-        for base in _mac_fonts_dirs():
-            for fn in cands:
-                p = os.path.join(base, fn)
-                if os.path.exists(p):
-                    return p
-    return None
+        cands += [os.path.join(base, fn) for base in _mac_fonts_dirs() for fn in mac.get(name, [])]
+    elif not sys.platform.startswith("win"):
+        sysf = _system_font_files()
+        cands += [sysf[fn.lower()] for fn in linux.get(name, []) if fn.lower() in sysf]
+    return cands
+
+
+_font_faces_cache: Dict[str, List[Tuple[int, str, str]]] = {}
+
+
+def _font_faces(path: str) -> List[Tuple[int, str, str]]:
+    # (index, family, style) for every face of a TTC/OTC, read once per file
+    faces = _font_faces_cache.get(path)
+    if faces is not None:
+        return faces
+    faces = []
+    try:
+        from PIL import ImageFont
+        i = 0
+        while i < 64:
+            try:
+                f = ImageFont.truetype(path, 12, index=i)
+            except OSError:
+                break
+            family, style = f.getname()
+            faces.append((i, family or "", style or ""))
+            i += 1
+    except Exception:
+        pass
+    _font_faces_cache[path] = faces
+    return faces
+
+
+def _pick_face(path: str, name: str) -> int:
+    if not path.lower().endswith((".ttc", ".otc")):
+        return 0
+    faces = _font_faces(path)
+    if not faces:
+        return 0
+    prefs = [x.lower() for x in _FONT_FAMILIES.get(name, [])]
+
+    def rank(face: Tuple[int, str, str]):
+        fam = face[1].lower()
+        hit = next((i for i, p in enumerate(prefs) if fam == p or fam.startswith(p)), len(prefs))
+        return (hit, " sc" not in fam, face[2].lower() not in {"regular", "book", "medium"}, face[0])
+
+    return min(faces, key=rank)[0]
+
+
+_font_table: Optional[Dict[str, Optional[Tuple[str, int]]]] = None
+
+
+def refresh_font_table() -> Dict[str, Optional[Tuple[str, int]]]:
+    global _font_table, _system_fonts
+    _system_fonts = None
+    table: Dict[str, Optional[Tuple[str, int]]] = {}
+    for name in _FONT_ALIASES:
+        p = next((p for p in _font_candidates(name) if os.path.exists(p)), None)
+        table[name] = (p, _pick_face(p, name)) if p else None
+    _font_table = table
+    return dict(table)
+
+
+def resolve_font_face(name: str) -> Optional[Tuple[str, int]]:
+    canon = _FONT_BY_ALIAS.get((name or "").strip().lower())
+    if canon is None:
+        return None
+    table = _font_table if _font_table is not None else refresh_font_table()
+    return table.get(canon)
+
+
+def resolve_font_by_name(name: str) -> Optional[str]:
+    face = resolve_font_face(name)
+    return face[0] if face else None
 
 
 def train_handwrite_style() -> Dict[str, str]:
     fonts = ensure_handwrite_assets()
     if not fonts:
         raise RuntimeError("未能下载手写体字体资源")
-    seed = int(time.time())
-    random.seed(seed)
+    rng = random.Random()
     style = {
-        "font": random.choice(fonts),
-        "font_size": random.choice([36, 40, 44]),
-        "line_gap": random.choice([14, 18, 22]),
+        "font": rng.choice(fonts),
+        "font_size": rng.choice([36, 40, 44]),
+        "line_gap": rng.choice([14, 18, 22]),
         "rotate_min": -2,
         "rotate_max": 2,
-        "jitter": random.choice([0, 1, 2]),
+        "jitter": rng.choice([0, 1, 2]),
     }
     _save_json(_HW_STYLE_FILE, style)
+    _hw_style_cache.put(style)
     return style
 
 
+_hw_style_cache = _JsonFileCache(_HW_STYLE_FILE)
+
+
 def _load_handwrite_style() -> Dict[str, str]:
-    cfg = _load_json(_HW_STYLE_FILE)
+    cfg = _hw_style_cache.get()
     if not isinstance(cfg, dict) or not cfg.get("font"):
         cfg = train_handwrite_style()
-    return cfg
+    return dict(cfg)
+
+
+# Rendered line masks ("L" images cropped to the ink bbox) with LRU eviction
+# bounded by total pixel bytes; boilerplate lines are rasterized once.
+class _LineRasterCache:
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._items: "OrderedDict[Tuple, Tuple]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Tuple):
+        with self._lock:
+            it = self._items.get(key)
+            if it is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return it
+
+    def put(self, key: Tuple, mask, offset: Tuple[int, int]) -> None:
+        size = mask.size[0] * mask.size[1]
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._bytes -= old[0].size[0] * old[0].size[1]
+            self._items[key] = (mask, offset)
+            self._bytes += size
+            while self._bytes > self.max_bytes and self._items:
+                _, (m, _) = self._items.popitem(last=False)
+                self._bytes -= m.size[0] * m.size[1]
 
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+            self._bytes = 0
 
-def generate_handwriting_image(text: str, out_path: str, style: Optional[Dict[str, str]] = None) -> str:
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._items), "bytes": self._bytes, "max_bytes": self.max_bytes}
+
+
+_line_cache = _LineRasterCache()
+
+
+def set_line_cache_limit(max_bytes: int) -> None:
+    _line_cache.max_bytes = max_bytes
+    if max_bytes <= 0:
+        _line_cache.clear()
+
+
+def line_cache_stats() -> Dict[str, int]:
+    return _line_cache.stats()
+
+
+# Loaded FreeTypeFont objects shared by every render in the process
+_fonts: Dict[Tuple[str, int, int], object] = {}
+_fonts_lock = threading.Lock()
+
+
+def _load_font(path: str, size: int, index: int = 0):
+    key = (path, size, index)
+    font = _fonts.get(key)
+    if font is None:
+        from PIL import ImageFont
+        font = ImageFont.truetype(path, size, index=index)
+        with _fonts_lock:
+            font = _fonts.setdefault(key, font)
+    return font
+
+
+def clear_font_cache() -> None:
+    with _fonts_lock:
+        _fonts.clear()
+    _line_cache.clear()
+
+
+def _line_raster(font, font_key: Tuple, line: str):
+    key = font_key + (line,)
+    it = _line_cache.get(key)
+    if it is not None:
+        return it
+    from PIL import Image, ImageDraw
+    l, t, r, b = font.getbbox(line)
+    if r <= l or b <= t:
+        return None
+    mask = Image.new("L", (r - l, b - t), 0)
+    ImageDraw.Draw(mask).text((-l, -t), line, font=font, fill=255)
+    _line_cache.put(key, mask, (l, t))
+    return mask, (l, t)
+
+
+def _compose_pil(lines, font, font_key, w, h, font_size, line_gap, jitter, rmin, rmax, rng, margin: int = 20):
+    from PIL import Image
+    img = Image.new("RGB", (w, h), color=(255, 255, 255))
+    y = margin
+    for line in lines:
+        dy = y + rng.randint(-jitter, jitter)
+        rot = rng.uniform(rmin, rmax)
+        dx = margin + rng.randint(0, jitter)
+        y += font_size + line_gap
+        it = _line_raster(font, font_key, line)
+        if it is None:
+            continue
+        mask, (ox, oy) = it
+        # Rotate the tight line surface about its own centre
+        cx = dx + ox + mask.size[0] / 2
+        cy = dy + oy + mask.size[1] / 2
+        rm = mask.rotate(rot, resample=Image.BICUBIC, expand=1)
+        img.paste((0, 0, 0), (int(round(cx - rm.size[0] / 2)), int(round(cy - rm.size[1] / 2))), rm)
+    return img
+
+
+def _compose_numpy(lines, font, font_key, w, h, font_size, line_gap, jitter, rmin, rmax, seed, margin: int = 20, batch: int = 16):
+    # Small-angle rotation as a vertical shear: a line of width W at angle a is
+    # sampled with each column shifted by (x - W/2) * tan(a). The horizontal
+    # part of the rotation is at most a pixel or two over a line's height and is
+    # dropped. All lines of a batch are sheared with one gather.
     try:
-        from PIL import Image, ImageDraw, ImageFont
+        import numpy as np
+    except Exception:
+        raise RuntimeError("未检测到NumPy，请先安装：pip install numpy")
+    from PIL import Image
+    rng = np.random.default_rng(seed)
+    n = len(lines)
+    dys = margin + np.arange(n) * (font_size + line_gap) + rng.integers(-jitter, jitter + 1, n)
+    tans = np.tan(np.radians(rng.uniform(rmin, rmax, n)))
+    dxs = margin + rng.integers(0, jitter + 1, n)
+    items = []
+    for i, line in enumerate(lines):
+        it = _line_raster(font, font_key, line)
+        if it is not None:
+            items.append((i, np.asarray(it[0], dtype=np.uint8), it[1]))
+    ink = np.zeros((h, w), dtype=np.uint8)
+    for k in range(0, len(items), batch):
+        chunk = items[k:k + batch]
+        idx = np.array([i for i, _, _ in chunk])
+        ws = np.array([m.shape[1] for _, m, _ in chunk])
+        hmax = max(m.shape[0] for _, m, _ in chunk)
+        t = tans[idx]
+        pad = int(np.ceil(np.abs(t * ws).max() / 2)) + 1
+        ho = hmax + 2 * pad
+        src = np.zeros((len(chunk), ho, ws.max()), dtype=np.uint8)
+        for j, (_, m, _) in enumerate(chunk):
+            src[j, pad:pad + m.shape[0], :m.shape[1]] = m
+        shift = np.rint((np.arange(src.shape[2])[None, :] - ws[:, None] / 2) * t[:, None]).astype(np.intp)
+        rows = (np.arange(ho)[None, :, None] - shift[:, None, :]) % ho
+        out = np.take_along_axis(src, rows, 1)
+        for j, (i, m, (ox, oy)) in enumerate(chunk):
+            top = int(dys[i] + oy - pad)
+            left = int(dxs[i] + ox)
+            t0, l0 = max(top, 0), max(left, 0)
+            t1, l1 = min(top + ho, h), min(left + m.shape[1], w)
+            if t1 <= t0 or l1 <= l0:
+                continue
+            region = ink[t0:t1, l0:l1]
+            np.maximum(region, out[j, t0 - top:t1 - top, l0 - left:l1 - left], out=region)
+    return Image.fromarray(255 - ink, "L").convert("RGB")
+
+
+def _handwriting_setup(style: Optional[Dict[str, str]]) -> Dict:
+    try:
+        from PIL import Image  # noqa: F401
     except Exception:
         raise RuntimeError("未检测到Pillow，请先安装：pip install pillow")
     cfg = style or _load_handwrite_style()
     font_path = cfg.get("font")
     font_size = int(cfg.get("font_size", 40))
-    line_gap = int(cfg.get("line_gap", 18))
-    rmin = float(cfg.get("rotate_min", -1))
-    rmax = float(cfg.get("rotate_max", 1))
-    jitter = int(cfg.get("jitter", 1))
+    font_index = int(cfg.get("font_index", 0))
     if not font_path or not os.path.exists(font_path):
         fname = (style or {}).get("font_name") if style else None
         if fname:
-            fp = resolve_font_by_name(fname)
-            if fp and os.path.exists(fp):
-                font_path = fp
+            face = resolve_font_face(fname)
+            if face and os.path.exists(face[0]):
+                font_path, font_index = face
     
     if not font_path or not os.path.exists(font_path):
         fonts = ensure_handwrite_assets()
         if not fonts:
             raise RuntimeError("无可用手写体字体")
         font_path = fonts[0]
-    # Pillow may have limited support for TTC; prefer TTF
-    if font_path.lower().endswith(".ttc"):
-        alt = os.path.join(_win_fonts_dir(), "simhei.ttf")
-        if os.path.exists(alt):
-            font_path = alt
-    font = ImageFont.truetype(font_path, font_size)
+        font_index = 0
+    return {
+        "cfg": cfg,
+        "font": _load_font(font_path, font_size, font_index),
+        "font_key": (font_path, font_size, font_index),
+        "font_size": font_size,
+        "line_gap": int(cfg.get("line_gap", 18)),
+        "rmin": float(cfg.get("rotate_min", -1)),
+        "rmax": float(cfg.get("rotate_max", 1)),
+        "jitter": int(cfg.get("jitter", 1)),
+    }
+
+
+def _compose(hw: Dict, lines: List[str], w: int, h: int, compositor: Optional[str], seed, rng, margin: int = 20):
+    args = (lines, hw["font"], hw["font_key"], w, h, hw["font_size"], hw["line_gap"], hw["jitter"], hw["rmin"], hw["rmax"])
+    if (compositor or hw["cfg"].get("compositor") or "pil") == "numpy":
+        return _compose_numpy(*args, seed, margin=margin)
+    return _compose_pil(*args, rng, margin=margin)
+
+
+def generate_handwriting_image(
+    text: str,
+    out_path: str,
+    style: Optional[Dict[str, str]] = None,
+    compositor: Optional[str] = None,
+    seed: Optional[int] = None,
+) -> str:
+    hw = _handwriting_setup(style)
+    font_size = hw["font_size"]
     lines = [x for x in (text or "").splitlines() if x.strip()]
     if not lines:
         lines = [" "]
     max_chars = max(len(x) for x in lines)
     w = max(800, int(max_chars * font_size * 0.7))
-    h = int(len(lines) * (font_size + line_gap) + 40)
-    img = Image.new("RGB", (w, h), color=(255, 255, 255))
-    draw = ImageDraw.Draw(img)
-    y = 20
-    for i, line in enumerate(lines):
-        dy = y + random.randint(-jitter, jitter)
-        rot = random.uniform(rmin, rmax)
-        tmp = Image.new("RGBA", (w, font_size + 8), (255, 255, 255, 0))
-        tdraw = ImageDraw.Draw(tmp)
-        tdraw.text((20 + random.randint(0, jitter), 0), line, font=font, fill=(0, 0, 0))
-        tmp = tmp.rotate(rot, resample=Image.BICUBIC, expand=1)
-        img.paste(Image.alpha_composite(Image.new("RGBA", tmp.size, (255, 255, 255, 0)), tmp), (0, dy), tmp)
-        y += font_size + line_gap
+    h = int(len(lines) * (font_size + hw["line_gap"]) + 40)
+    rng = random.Random(seed) if seed is not None else random
+    img = _compose(hw, lines, w, h, compositor, seed, rng)
     os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
     img.save(out_path)
     return out_path
 
 
+# Bump when compositor output changes so stale cache entries are not reused
+_HW_RENDER_VERSION = 1
+
+
+def _handwriting_key(text: str, hw: Dict, compositor: str) -> str:
+    cfg = {
+        "v": _HW_RENDER_VERSION,
+        "text": text or "",
+        "font": list(hw["font_key"]),
+        "line_gap": hw["line_gap"],
+        "rotate": [hw["rmin"], hw["rmax"]],
+        "jitter": hw["jitter"],
+        "compositor": compositor,
+    }
+    raw = json.dumps(cfg, ensure_ascii=False, sort_keys=True).encode("utf-8")
+    return hashlib.sha256(raw).hexdigest()
+
+
+def render_handwriting_cached(
+    text: str,
+    style: Optional[Dict[str, str]] = None,
+    compositor: Optional[str] = None,
+    cache_dir: Optional[str] = None,
+) -> str:
+    # Seed comes from the content hash, so the same text + style always gives
+    # the same image and a repeat request is just a file lookup.
+    hw = _handwriting_setup(style)
+    compositor = compositor or hw["cfg"].get("compositor") or "pil"
+    key = _handwriting_key(text, hw, compositor)
+    d = cache_dir or os.path.join(os.getcwd(), _HW_CACHE_DIR)
+    path = os.path.join(d, key + ".png")
+    if os.path.exists(path):
+        return path
+    tmp = os.path.join(d, f".{key}.{os.getpid()}.{threading.get_ident()}.png")
+    font_path, font_size, font_index = hw["font_key"]
+    cfg = dict(hw["cfg"], font=font_path, font_size=font_size, font_index=font_index)
+    generate_handwriting_image(text, tmp, cfg, compositor, seed=int(key[:16], 16))
+    os.replace(tmp, path)
+    return path
+
+
+# A4 at 150 dpi
+A4_PAGE = (1240, 1754)
+_NO_LINE_START = set("，。、；：？！）》」』”’,.;:?!)")
+_advances: Dict[Tuple, float] = {}
+
+
+def _advance(font, font_key: Tuple, ch: str) -> float:
+    k = font_key + (ch,)
+    v = _advances.get(k)
+    if v is None:
+        v = _advances[k] = font.getlength(ch)
+    return v
+
+
+def _wrap_lines(text: str, font, font_key: Tuple, max_width: float):
+    # Greedy wrap on per-glyph advances; closing punctuation stays on the line
+    for para in (text or "").splitlines():
+        if not para.strip():
+            continue
+        cur: List[str] = []
+        width = 0.0
+        for ch in para:
+            adv = _advance(font, font_key, ch)
+            if cur and width + adv > max_width and ch not in _NO_LINE_START:
+                yield "".join(cur)
+                cur, width = [], 0.0
+            cur.append(ch)
+            width += adv
+        if cur:
+            yield "".join(cur)
+
+
+def generate_handwriting_pages(
+    text: str,
+    out_path: str,
+    style: Optional[Dict[str, str]] = None,
+    compositor: Optional[str] = None,
+    seed: Optional[int] = None,
+    page_size: Tuple[int, int] = A4_PAGE,
+    margin: int = 90,
+) -> List[str]:
+    # One page is composed and written at a time: .pdf and .tif/.tiff become a
+    # single multi-page file, anything else one file per page (name_001.png ...)
+    hw = _handwriting_setup(style)
+    from PIL import TiffImagePlugin
+    pw, ph = page_size
+    step = hw["font_size"] + hw["line_gap"]
+    per_page = max(1, (ph - 2 * margin) // step)
+    rng = random.Random(seed) if seed is not None else random
+    base, ext = os.path.splitext(out_path)
+    ext = ext.lower()
+    os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+    outs: List[str] = []
+    tiff = None
+    if ext in {".tif", ".tiff"}:
+        tiff = TiffImagePlugin.AppendingTiffWriter(out_path, True)
+    try:
+        page: List[str] = []
+        no = 0
+
+        def flush():
+            img = _compose(hw, page, pw, ph, compositor, None if seed is None else [seed, no], rng, margin=margin)
+            if tiff is not None:
+                img.save(tiff, format="TIFF", compression="tiff_deflate")
+                tiff.newFrame()
+                if not outs:
+                    outs.append(out_path)
+            elif ext == ".pdf":
+                img.save(out_path, format="PDF", append=no > 0, resolution=150.0)
+                if not outs:
+                    outs.append(out_path)
+            else:
+                p = f"{base}_{no + 1:03d}{ext or '.png'}"
+                img.save(p)
+                outs.append(p)
+
+        for line in _wrap_lines(text, hw["font"], hw["font_key"], pw - 2 * margin):
+            page.append(line)
+            if len(page) == per_page:
+                flush()
+                page = []
+                no += 1
+        if page or no == 0:
+            flush()
+    finally:
+        if tiff is not None:
+            tiff.close()
+    return outs
+
+
+def save_docx(text: str, path: str) -> str:
+    try:
+        import docx
+    except Exception:
+        raise RuntimeError("未检测到python-docx，请先安装：pip install python-docx")
+    doc = docx.Document()
+    for line in text.splitlines():
+        doc.add_paragraph(line)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    doc.save(path)
+    return path
+
+
 def auto_generate_image_for_document(template_id: str, data: Dict[str, str], style: str = "formal", out_dir: Optional[str] = None) -> str:
+    # Rendered through the image cache, then copied out as <template_id>_<ts>.png
     txt = generate_document(template_id, data, style)
+    src = render_handwriting_cached(txt)
     d = out_dir or os.path.join(os.getcwd(), "handwrite_output")
     os.makedirs(d, exist_ok=True)
-    fname = f"{template_id}_{int(time.time())}.png"
-    path = os.path.join(d, fname)
-    return generate_handwriting_image(txt, path)
+    path = os.path.join(d, f"{template_id}_{int(time.time())}.png")
+    shutil.copyfile(src, path)
+    return path
 
 
-def batch_generate_images(input_dir: str, output_dir: str, encoding: str = "utf-8") -> List[str]:
-    outs: List[str] = []
+def _list_batch_inputs(input_dir: str, output_dir: str) -> List[Tuple[str, str]]:
+    items: List[Tuple[str, str]] = []
+    for root, dirs, files in os.walk(input_dir):
+        dirs.sort()
+        for fn in sorted(files):
+            if fn.lower().endswith(".txt"):
+                items.append((os.path.join(root, fn), os.path.join(output_dir, os.path.splitext(fn)[0] + ".png")))
+    return items
+
+
+_worker_style: Optional[Dict[str, str]] = None
+
+
+def _batch_worker_init(style: Dict[str, str]) -> None:
+    global _worker_style
+    _worker_style = style
+
+
+def _batch_render_one(job: Tuple[str, str, str]) -> Dict:
+    ip, op, encoding = job
+    t0 = time.perf_counter()
+    rec = {"input": ip, "output": op, "status": "ok", "seconds": 0.0, "error": ""}
+    try:
+        with open(ip, "r", encoding=encoding) as f:
+            txt = f.read()
+        generate_handwriting_image(txt, op, _worker_style)
+    except Exception as e:
+        rec["status"] = "error"
+        rec["error"] = f"{type(e).__name__}: {e}"
+    rec["seconds"] = time.perf_counter() - t0
+    return rec
+
+
+def batch_render_images(
+    input_dir: str,
+    output_dir: str,
+    encoding: str = "utf-8",
+    workers: Optional[int] = None,
+    chunksize: int = 4,
+    style: Optional[Dict[str, str]] = None,
+) -> List[Dict]:
     if not os.path.isdir(input_dir):
-        return outs
+        return []
     os.makedirs(output_dir, exist_ok=True)
-    for root, _, files in os.walk(input_dir):
-        for fn in files:
-            if fn.lower().endswith(".txt"):
-                ip = os.path.join(root, fn)
-                try:
-                    with open(ip, "r", encoding=encoding) as f:
-                        txt = f.read()
-                    op = os.path.join(output_dir, os.path.splitext(fn)[0] + ".png")
-                    outs.append(generate_handwriting_image(txt, op))
-                except Exception:
-                    pass
-    return outs
+    jobs = [(ip, op, encoding) for ip, op in _list_batch_inputs(input_dir, output_dir)]
+    if not jobs:
+        return []
+    # Resolve the style once here rather than once per file in every worker
+    try:
+        cfg = style or _load_handwrite_style()
+    except Exception as e:
+        return [{"input": ip, "output": op, "status": "error", "seconds": 0.0, "error": f"{type(e).__name__}: {e}"} for ip, op, _ in jobs]
+    workers = workers or os.cpu_count() or 1
+    if workers <= 1 or len(jobs) == 1:
+        _batch_worker_init(cfg)
+        return [_batch_render_one(j) for j in jobs]
+    from concurrent.futures import ProcessPoolExecutor
+    results: List[Dict] = []
+    try:
+        with ProcessPoolExecutor(max_workers=min(workers, len(jobs)), initializer=_batch_worker_init, initargs=(cfg,)) as ex:
+            for rec in ex.map(_batch_render_one, jobs, chunksize=max(1, chunksize)):
+                results.append(rec)
+    except Exception as e:
+        for ip, op, _ in jobs[len(results):]:
+            results.append({"input": ip, "output": op, "status": "error", "seconds": 0.0, "error": f"{type(e).__name__}: {e}"})
+    return results
+
+
+def batch_generate_images(input_dir: str, output_dir: str, encoding: str = "utf-8", workers: int = 1) -> List[str]:
+    return [r["output"] for r in batch_render_images(input_dir, output_dir, encoding, workers) if r["status"] == "ok"]
+
+
+# Newest entries kept in history.db; None keeps everything
+_history_retention: Optional[int] = 10000
+# Blobs at least this large are stored zlib-compressed when that saves space
+_BLOB_COMPRESS_MIN = 256
+_history_local = threading.local()
+_HEX64 = re.compile(r"[0-9a-f]{64}")
+
+
+def set_history_retention(n: Optional[int]) -> None:
+    global _history_retention
+    _history_retention = n if n and n > 0 else None
+
+
+def _history_db() -> sqlite3.Connection:
+    # One connection per thread and database path (workers write, the UI reads)
+    path = os.path.abspath(_HISTORY_DB)
+    conns = getattr(_history_local, "conns", None)
+    if conns is None:
+        conns = _history_local.conns = {}
+    con = conns.get(path)
+    if con is None:
+        con = sqlite3.connect(path, timeout=10)
+        con.row_factory = sqlite3.Row
+        con.execute("PRAGMA journal_mode=WAL")
+        # Texts and field payloads live once in blobs, keyed by sha256;
+        # entries only reference them
+        con.execute("CREATE TABLE IF NOT EXISTS blobs (hash TEXT PRIMARY KEY, zipped INTEGER NOT NULL, body BLOB NOT NULL)")
+        con.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, ts INTEGER NOT NULL, template_id TEXT NOT NULL, "
+            "data_hash TEXT NOT NULL, text_hash TEXT NOT NULL, image TEXT NOT NULL DEFAULT '', "
+            "title TEXT NOT NULL DEFAULT '')"
+        )
+        con.execute("CREATE INDEX IF NOT EXISTS entries_tpl_ts ON entries(template_id, ts, id)")
+        con.execute("CREATE INDEX IF NOT EXISTS entries_ts ON entries(ts, id)")
+        con.commit()
+        _migrate_history(con)
+        conns[path] = con
+    return con
+
+
+def _put_blob(con: sqlite3.Connection, raw: bytes) -> str:
+    h = hashlib.sha256(raw).hexdigest()
+    body, zipped = raw, 0
+    if len(raw) >= _BLOB_COMPRESS_MIN:
+        z = zlib.compress(raw, 6)
+        if len(z) < len(raw):
+            body, zipped = z, 1
+    con.execute("INSERT OR IGNORE INTO blobs (hash, zipped, body) VALUES (?, ?, ?)", (h, zipped, body))
+    return h
+
+
+def _get_blob(con: sqlite3.Connection, h: str) -> Optional[bytes]:
+    row = con.execute("SELECT zipped, body FROM blobs WHERE hash = ?", (h,)).fetchone()
+    if row is None:
+        return None
+    return zlib.decompress(row["body"]) if row["zipped"] else bytes(row["body"])
+
+
+def _image_ref(image_path: Optional[str]) -> str:
+    # Images from the render cache are already content-addressed: keep the key
+    if not image_path:
+        return ""
+    name, ext = os.path.splitext(os.path.basename(image_path))
+    if ext == ".png" and _HEX64.fullmatch(name) and os.path.abspath(image_path) == os.path.abspath(os.path.join(_HW_CACHE_DIR, name + ".png")):
+        return name
+    return image_path
+
+
+def _image_path(ref: str) -> str:
+    if _HEX64.fullmatch(ref or ""):
+        return os.path.abspath(os.path.join(_HW_CACHE_DIR, ref + ".png"))
+    return ref or ""
+
+
+def _history_title(text: str) -> str:
+    for line in (text or "").splitlines():
+        line = line.strip()
+        if line:
+            return line[:80]
+    return ""
+
+
+def _insert_history(con: sqlite3.Connection, ts: int, template_id: str, data: Dict, text: str, image_path: Optional[str]) -> int:
+    dh = _put_blob(con, json.dumps(data or {}, ensure_ascii=False, sort_keys=True).encode("utf-8"))
+    th = _put_blob(con, (text or "").encode("utf-8"))
+    cur = con.execute(
+        "INSERT INTO entries (ts, template_id, data_hash, text_hash, image, title) VALUES (?, ?, ?, ?, ?, ?)",
+        (ts, template_id, dh, th, _image_ref(image_path), _history_title(text)),
+    )
+    return cur.lastrowid
 
-def add_history(template_id: str, data: Dict[str, str], text: str, image_path: Optional[str]) -> None:
-    item = {
-        "ts": int(time.time()),
-        "template_id": template_id,
-        "data": data,
-        "text": text,
-        "image_path": image_path or "",
+
+def _migrate_history(con: sqlite3.Connection) -> None:
+    # One-off import of the legacy history.json list; the write lock keeps a
+    # second process from importing it again
+    if not os.path.exists(_HISTORY_FILE):
+        return
+    con.execute("BEGIN IMMEDIATE")
+    try:
+        if os.path.exists(_HISTORY_FILE):
+            store = _load_json(_HISTORY_FILE)
+            items = store.get("items", []) if isinstance(store, dict) else []
+            for it in sorted((x for x in items if isinstance(x, dict)), key=lambda x: x.get("ts") or 0):
+                _insert_history(con, int(it.get("ts") or 0), it.get("template_id") or "", it.get("data") or {}, it.get("text") or "", it.get("image_path"))
+            os.replace(_HISTORY_FILE, _HISTORY_FILE + ".bak")
+        con.commit()
+    except Exception:
+        con.rollback()
+        raise
+
+
+def _history_entry(row: sqlite3.Row) -> Dict:
+    # Light record: payloads stay as hashes until resolve_history()
+    return {
+        "id": row["id"],
+        "ts": row["ts"],
+        "template_id": row["template_id"],
+        "data_hash": row["data_hash"],
+        "text_hash": row["text_hash"],
+        "image_path": _image_path(row["image"]),
+        "title": row["title"],
     }
-    store = _load_json(_HISTORY_FILE)
-    if not isinstance(store, dict):
-        store = {}
-    lst = store.get("items", [])
-    if not isinstance(lst, list):
-        lst = []
-    lst.append(item)
-    lst = lst[-100:]
-    store["items"] = lst
-    _save_json(_HISTORY_FILE, store)
-
-def list_history() -> List[Dict[str, str]]:
-    store = _load_json(_HISTORY_FILE)
-    items = store.get("items", []) if isinstance(store, dict) else []
-    items = sorted(items, key=lambda x: x.get("ts", 0), reverse=True)
-    return items
 
-def latest_history_for_template(template_id: str) -> Optional[Dict[str, str]]:
-    for it in list_history():
-        if it.get("template_id") == template_id:
-            return it
-    return None
+
+def resolve_history(entry: Dict) -> Dict:
+    con = _history_db()
+    raw = _get_blob(con, entry.get("data_hash") or "")
+    try:
+        data = json.loads(raw.decode("utf-8")) if raw is not None else {}
+    except Exception:
+        data = {}
+    raw = _get_blob(con, entry.get("text_hash") or "")
+    return dict(entry, data=data, text=raw.decode("utf-8") if raw is not None else "")
+
+
+def add_history(template_id: str, data: Dict[str, str], text: str, image_path: Optional[str]) -> int:
+    con = _history_db()
+    with con:
+        hid = _insert_history(con, int(time.time()), template_id, data, text, image_path)
+        if _history_retention and hid > _history_retention:
+            # ids only grow, so the oldest rows are a primary-key range
+            pruned = con.execute("DELETE FROM entries WHERE id <= ?", (hid - _history_retention,)).rowcount
+            if pruned and hid % 256 == 0:
+                con.execute(
+                    "DELETE FROM blobs WHERE hash NOT IN "
+                    "(SELECT data_hash FROM entries UNION SELECT text_hash FROM entries)"
+                )
+    return hid
+
+
+def list_history(limit: Optional[int] = None, offset: int = 0, template_id: Optional[str] = None) -> List[Dict]:
+    # Newest first, with data and text loaded as before the blob table
+    return [resolve_history(it) for it in list_history_entries(limit, offset, template_id)]
+
+
+def list_history_entries(limit: Optional[int] = None, offset: int = 0, template_id: Optional[str] = None) -> List[Dict]:
+    # Like list_history, but payloads stay as hashes (see resolve_history)
+    sql = "SELECT * FROM entries"
+    args: list = []
+    if template_id:
+        sql += " WHERE template_id = ?"
+        args.append(template_id)
+    sql += " ORDER BY ts DESC, id DESC LIMIT ? OFFSET ?"
+    args += [-1 if limit is None else limit, max(0, offset)]
+    return [_history_entry(r) for r in _history_db().execute(sql, args)]
+
+
+def history_page(page: int = 0, page_size: int = 50, template_id: Optional[str] = None, query: Optional[str] = None) -> Dict:
+    # Summaries only (id, template_id, ts, title = first line of the text);
+    # fetch the full entry with get_history(id)
+    sql = "SELECT id, ts, template_id, title FROM entries"
+    where: List[str] = []
+    args: list = []
+    if template_id:
+        where.append("template_id = ?")
+        args.append(template_id)
+    for term in (query or "").split():
+        esc = term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        where.append("(title LIKE ? ESCAPE '\\' OR template_id LIKE ? ESCAPE '\\')")
+        args += [f"%{esc}%"] * 2
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    page = max(0, page)
+    sql += " ORDER BY ts DESC, id DESC LIMIT ? OFFSET ?"
+    args += [page_size + 1, page * page_size]
+    rows = _history_db().execute(sql, args).fetchall()
+    items = [{"id": r["id"], "template_id": r["template_id"], "ts": r["ts"], "title": r["title"]} for r in rows[:page_size]]
+    return {"items": items, "page": page, "has_more": len(rows) > page_size}
+
+
+def get_history(history_id: int) -> Optional[Dict]:
+    row = _history_db().execute("SELECT * FROM entries WHERE id = ?", (history_id,)).fetchone()
+    return resolve_history(_history_entry(row)) if row else None
+
+
+def latest_history_for_template(template_id: str) -> Optional[Dict]:
+    items = list_history(limit=1, template_id=template_id)
+    return items[0] if items else None
 
@@ -0,0 +1,213 @@
+import argparse
+import csv
+import json
+import os
+import queue
+import re
+import sys
+import threading
+import time
+from concurrent.futures import Executor
+from typing import Dict, Iterator, List, Optional
+
+import document_gen as dg
+
+
+_RESERVED = {"template_id", "style", "name"}
+_UNSAFE_CHARS = re.compile(r'[\x00-\x1f<>:"/\\|?*]')
+
+
+def read_records(path: str, encoding: str = "utf-8-sig") -> Iterator[Dict]:
+    # CSV: template_id/style/name columns, every other column is a field.
+    # JSONL: {"template_id": ..., "style": ..., "name": ..., "fields": {...}}
+    # A JSONL line that cannot be used yields {"line": n, "error": ...} instead
+    # of aborting the batch. utf-8-sig also strips the BOM Excel writes.
+    with open(path, "r", encoding=encoding, newline="") as f:
+        if path.lower().endswith(".csv"):
+            for row in csv.DictReader(f):
+                yield {
+                    "template_id": (row.get("template_id") or "").strip(),
+                    "style": (row.get("style") or "").strip() or "formal",
+                    "name": (row.get("name") or "").strip(),
+                    "fields": {k: v for k, v in row.items() if k and k not in _RESERVED and v is not None},
+                }
+            return
+        for n, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                r = json.loads(line)
+            except ValueError as e:
+                yield {"line": n, "error": f"第{n}行不是有效的JSON：{e}"}
+                continue
+            if not isinstance(r, dict):
+                yield {"line": n, "error": f"第{n}行不是JSON对象，已跳过"}
+                continue
+            yield {
+                "template_id": r.get("template_id") or "",
+                "style": r.get("style") or "formal",
+                "name": r.get("name") or "",
+                "fields": r.get("fields") or {},
+            }
+
+
+def _write_txt(text: str, path: str, _style) -> None:
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+
+
+def _write_docx(text: str, path: str, _style) -> None:
+    dg.save_docx(text, path)
+
+
+def _write_png(text: str, path: str, style) -> None:
+    dg.generate_handwriting_image(text, path, style)
+
+
+def _write_pdf(text: str, path: str, style) -> None:
+    dg.generate_handwriting_pages(text, path, style)
+
+
+_WRITERS = {"txt": _write_txt, "docx": _write_docx, "png": _write_png, "pdf": _write_pdf}
+
+
+def _safe_name(name: str) -> str:
+    # A record name becomes exactly one file name component: separators and
+    # characters Windows rejects turn into "_", leading dots/spaces are dropped
+    return _UNSAFE_CHARS.sub("_", str(name)).strip().lstrip(".").strip()[:120]
+
+
+def _output_path(out_dir: str, name: str, fmt: str) -> str:
+    path = os.path.join(out_dir, f"{name}.{fmt}")
+    if os.path.dirname(os.path.realpath(path)) != os.path.realpath(out_dir):
+        raise ValueError(f"输出文件名无效：{name}")
+    return path
+
+
+def run_pipeline(
+    records,
+    out_dir: str,
+    formats=("txt",),
+    queue_size: int = 64,
+    png_workers: int = 2,
+    hw_style: Optional[Dict[str, str]] = None,
+    image_pool: Optional[Executor] = None,
+) -> Dict:
+    # image_pool (e.g. a process pool) takes the PNG/PDF writes off this
+    # process; png_workers then bounds how many are in flight
+    formats = [x for x in formats if x]
+    bad = [x for x in formats if x not in _WRITERS]
+    if bad:
+        raise ValueError(f"不支持的输出格式：{', '.join(bad)}")
+    if "docx" in formats:
+        try:
+            import docx  # noqa: F401
+        except Exception:
+            raise RuntimeError("未检测到python-docx，请先安装：pip install python-docx")
+    out_dir = os.path.abspath(out_dir)
+    os.makedirs(out_dir, exist_ok=True)
+    if ("png" in formats or "pdf" in formats) and hw_style is None:
+        hw_style = dg._load_handwrite_style()
+    stats = {"records": 0, "written": {x: 0 for x in formats}, "errors": []}
+    lock = threading.Lock()
+
+    def fail(name: str, stage: str, e) -> None:
+        with lock:
+            msg = e if isinstance(e, str) else f"{type(e).__name__}: {e}"
+            stats["errors"].append({"name": name, "stage": stage, "error": msg})
+
+    # One bounded queue per format; a full queue blocks the reader (backpressure)
+    queues = {x: queue.Queue(maxsize=max(1, queue_size)) for x in formats}
+    threads: List[threading.Thread] = []
+
+    def consume(fmt: str) -> None:
+        q = queues[fmt]
+        write = _WRITERS[fmt]
+        while True:
+            job = q.get()
+            if job is None:
+                return
+            name, text = job
+            try:
+                path = _output_path(out_dir, name, fmt)
+                if image_pool is not None and fmt in ("png", "pdf"):
+                    image_pool.submit(write, text, path, hw_style).result()
+                else:
+                    write(text, path, hw_style)
+                with lock:
+                    stats["written"][fmt] += 1
+            except Exception as e:
+                fail(name, fmt, e)
+
+    for fmt in formats:
+        for _ in range(max(1, png_workers) if fmt in ("png", "pdf") else 1):
+            t = threading.Thread(target=consume, args=(fmt,), daemon=True)
+            t.start()
+            threads.append(t)
+    # Names already given out this batch (case-insensitive, as on Windows)
+    used = set()
+    t0 = time.perf_counter()
+    try:
+        for i, rec in enumerate(records):
+            stats["records"] += 1
+            if rec.get("error"):
+                fail(f"line {rec.get('line')}", "read", rec["error"])
+                continue
+            name = _safe_name(rec.get("name") or "") or _safe_name(f"{i:06d}_{rec.get('template_id') or 'unknown'}")
+            base, k = name, 1
+            while name.lower() in used:
+                # A repeated name gets _2, _3, ... instead of overwriting
+                k += 1
+                name = f"{base}_{k}"
+            used.add(name.lower())
+            try:
+                text = dg.generate_document(rec.get("template_id") or "", rec.get("fields") or {}, rec.get("style") or "formal")
+            except Exception as e:
+                fail(name, "render", e)
+                continue
+            for fmt in formats:
+                queues[fmt].put((name, text))
+    finally:
+        for fmt in formats:
+            for _ in range(max(1, png_workers) if fmt in ("png", "pdf") else 1):
+                queues[fmt].put(None)
+        for t in threads:
+            t.join()
+    stats["seconds"] = time.perf_counter() - t0
+    return stats
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    ap = argparse.ArgumentParser(description="批量生成文书：从CSV/JSONL读取字段，输出TXT/DOCX/PNG/PDF")
+    ap.add_argument("input", help="CSV 或 JSONL 文件")
+    ap.add_argument("-o", "--out-dir", default="batch_output")
+    ap.add_argument("-f", "--formats", default="txt", help="逗号分隔：txt,docx,png,pdf（pdf为A4分页手写件）")
+    ap.add_argument("--encoding", default="utf-8-sig")
+    ap.add_argument("--queue-size", type=int, default=64)
+    ap.add_argument("--png-workers", type=int, default=2)
+    ap.add_argument("--font-name", default="", help="手写图片字体，如 手写-马善政、宋体")
+    args = ap.parse_args(argv)
+    formats = [x.strip().lower() for x in args.formats.split(",") if x.strip()]
+    hw_style = {"font_name": args.font_name} if args.font_name else None
+    try:
+        stats = run_pipeline(
+            read_records(args.input, args.encoding),
+            args.out_dir,
+            formats,
+            queue_size=args.queue_size,
+            png_workers=args.png_workers,
+            hw_style=hw_style,
+        )
+    except (RuntimeError, ValueError, OSError) as e:
+        print(f"错误：{e}", file=sys.stderr)
+        return 2
+    for e in stats["errors"]:
+        print(f"[{e['stage']}] {e['name']}: {e['error']}", file=sys.stderr)
+    written = "，".join(f"{k} {v}" for k, v in stats["written"].items())
+    print(f"共 {stats['records']} 条记录，{written}，失败 {len(stats['errors'])}，用时 {stats['seconds']:.1f}s")
+    return 1 if stats["errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,140 @@
+import queue
+import threading
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Optional, Tuple
+
+import document_gen as dg
+
+
+def render_document(template_id: str, data: Dict[str, str], style: str = "formal", hw_style: Optional[Dict[str, str]] = None, history: bool = True) -> Tuple[str, str]:
+    text = dg.generate_document(template_id, data, style)
+    img_path = dg.render_handwriting_cached(text, hw_style)
+    if history:
+        dg.add_history(template_id, data, text, img_path)
+    return text, img_path
+
+
+class _Job:
+    __slots__ = ("key", "seq", "fn", "args", "kwargs", "future", "on_done", "on_error")
+
+    def __init__(self, key, seq, fn, args, kwargs, on_done, on_error):
+        self.key = key
+        self.seq = seq
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.future: Future = Future()
+        self.on_done = on_done
+        self.on_error = on_error
+
+
+class RenderService:
+    # Fixed worker pool over a bounded queue of job keys. Submitting a key that
+    # is still waiting replaces the waiting job (its future is cancelled);
+    # a job that is already running finishes, but its callbacks are dropped
+    # once a newer job for the same key exists.
+    #
+    # dispatch(fn) decides where callbacks run: None runs them on the worker,
+    # a GUI passes something that hands them to its main loop.
+    def __init__(self, workers: int = 2, max_pending: int = 32, dispatch: Optional[Callable[[Callable[[], None]], None]] = None):
+        self._q: "queue.Queue" = queue.Queue(maxsize=max(1, max_pending))
+        self._pending: Dict[object, _Job] = {}
+        self._latest: Dict[object, int] = {}
+        self._running = 0
+        self._seq = 0
+        self._lock = threading.Lock()
+        self._dispatch = dispatch
+        self._closed = False
+        self._threads: List[threading.Thread] = []
+        for i in range(max(1, workers)):
+            t = threading.Thread(target=self._work, name=f"render-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, key, fn: Callable, *args, on_done: Optional[Callable] = None, on_error: Optional[Callable] = None, **kwargs) -> Future:
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("渲染服务已关闭")
+            self._seq += 1
+            job = _Job(key, self._seq, fn, args, kwargs, on_done, on_error)
+            old = self._pending.get(key)
+            if old is None:
+                try:
+                    self._q.put_nowait(key)
+                except queue.Full:
+                    raise RuntimeError("渲染队列已满，请稍后再试")
+            else:
+                old.future.cancel()
+            self._pending[key] = job
+            self._latest[key] = job.seq
+        return job.future
+
+    def cancel(self, key) -> bool:
+        # Drops a waiting job and the callbacks of a running one
+        with self._lock:
+            job = self._pending.pop(key, None)
+            self._latest.pop(key, None)
+        return bool(job and job.future.cancel())
+
+    def busy(self) -> bool:
+        with self._lock:
+            return bool(self._pending) or self._running > 0
+
+    def shutdown(self, wait: bool = True) -> None:
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            for job in self._pending.values():
+                job.future.cancel()
+            self._pending.clear()
+        for _ in self._threads:
+            self._q.put(None)
+        if wait:
+            for t in self._threads:
+                t.join()
+
+    def _work(self) -> None:
+        while True:
+            key = self._q.get()
+            if key is None:
+                return
+            with self._lock:
+                job = self._pending.pop(key, None)
+                if job is None:
+                    continue
+                self._running += 1
+            ran, cb = False, None
+            try:
+                if job.future.set_running_or_notify_cancel():
+                    ran = True
+                    try:
+                        result = job.fn(*job.args, **job.kwargs)
+                    except Exception as e:
+                        job.future.set_exception(e)
+                        cb, value = job.on_error, e
+                    else:
+                        job.future.set_result(result)
+                        cb, value = job.on_done, result
+            finally:
+                # The job stops counting as running before its callback is
+                # dispatched, so a callback that asks busy() sees it finished
+                with self._lock:
+                    self._running -= 1
+                    current = ran and self._latest.get(key) == job.seq
+                    if current:
+                        del self._latest[key]
+            if current and cb is not None:
+                self._callback(cb, value)
+
+    def _callback(self, cb: Callable, value) -> None:
+        def call():
+            try:
+                cb(value)
+            except Exception:
+                pass
+
+        if self._dispatch is None:
+            call()
+        else:
+            self._dispatch(call)
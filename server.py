@@ -0,0 +1,362 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+import document_gen as dg
+import pipeline
+
+# Local HTTP/JSON front end for the engine (stdlib only):
+#   GET  /health                   cache and queue stats
+#   GET  /templates[?q=]           template summaries (search like the GUI)
+#   GET  /templates/<id>           summary plus field names
+#   POST /render/text              {template_id, data, style} -> {text}
+#   POST /render/image             {template_id, data, style} or {text}, plus
+#                                  optional hw_style / compositor -> image/png
+#                                  ({"return": "path"} gives {path} instead)
+#   POST /batch                    {records, formats} -> {job_id}, written
+#                                  to batch_output/<job_id>
+#   GET  /batch/<job_id>           job status and pipeline stats
+# Text rendering runs on the loop's default thread pool, so a large field
+# never stalls other connections. Handwriting images (batch PNG/PDF
+# included) go to a process pool whose workers keep templates and fonts
+# loaded.
+# Images come from the shared content-addressed cache on disk, so a repeat
+# request costs one file read.
+
+_MAX_BODY = 16 * 1024 * 1024
+_REASONS = {200: "OK", 202: "Accepted", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 413: "Payload Too Large", 500: "Internal Server Error", 503: "Service Unavailable"}
+_MAX_HEADERS = 100
+_KEEP_JOBS = 1000
+# hw_style keys a client may set, with their bounds; fonts are chosen by
+# name only, never by path
+_HW_LIMITS = {"font_size": (8, 160), "line_gap": (0, 160), "jitter": (0, 8), "rotate_min": (-15, 15), "rotate_max": (-15, 15)}
+_COMPOSITORS = ("pil", "numpy")
+
+
+class HttpError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+def _warm_worker(hw_style: Optional[Dict[str, str]]) -> None:
+    dg.template_list()
+    dg.style_names()
+    if hw_style is not None:
+        try:
+            dg._handwriting_setup(hw_style)
+        except Exception:
+            pass
+
+
+def _render_image(text: str, hw_style: Optional[Dict[str, str]], compositor: Optional[str]) -> str:
+    return dg.render_handwriting_cached(text, hw_style, compositor)
+
+
+class DocServer:
+    def __init__(self, workers: Optional[int] = None, hw_style: Optional[Dict[str, str]] = None, max_batch_jobs: int = 4):
+        self.workers = workers or max(1, (os.cpu_count() or 2) - 1)
+        self.hw_style = hw_style
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._jobs: Dict[str, Dict] = {}
+        self._batch_slots = threading.BoundedSemaphore(max(1, max_batch_jobs))
+        self.requests = 0
+        self.started = time.time()
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8765) -> asyncio.AbstractServer:
+        dg.template_list()
+        self._pool = ProcessPoolExecutor(max_workers=self.workers, initializer=_warm_worker, initargs=(self.hw_style,))
+        return await asyncio.start_server(self._handle, host, port)
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except (ConnectionError, asyncio.LimitOverrunError, ValueError):
+                    return
+                if not line:
+                    return
+                parts = line.decode("latin-1").split()
+                if len(parts) != 3:
+                    await self._send(writer, 400, {"error": "请求格式错误"}, keep_alive=False)
+                    return
+                method, target, version = parts
+                headers: Dict[str, str] = {}
+                while True:
+                    try:
+                        h = await reader.readline()
+                    except (asyncio.LimitOverrunError, ValueError):
+                        h = None
+                    if h is None:
+                        await self._send(writer, 400, {"error": "请求头过长"}, keep_alive=False)
+                        return
+                    if h in (b"\r\n", b"\n", b""):
+                        break
+                    if len(headers) >= _MAX_HEADERS:
+                        await self._send(writer, 400, {"error": "请求头过多"}, keep_alive=False)
+                        return
+                    k, _, v = h.decode("latin-1").partition(":")
+                    headers[k.strip().lower()] = v.strip()
+                conn = headers.get("connection", "").lower()
+                keep_alive = conn == "keep-alive" if version == "HTTP/1.0" else conn != "close"
+                try:
+                    length = int(headers.get("content-length") or 0)
+                except ValueError:
+                    length = -1
+                if length < 0 or length > _MAX_BODY:
+                    await self._send(writer, 413 if length > 0 else 400, {"error": "请求体过大或长度无效"}, keep_alive=False)
+                    return
+                body = await reader.readexactly(length) if length else b""
+                self.requests += 1
+                try:
+                    status, payload, ctype, extra = await self._dispatch(method, target, body)
+                except HttpError as e:
+                    status, payload, ctype, extra = e.status, {"error": str(e)}, None, {}
+                except ValueError as e:
+                    status, payload, ctype, extra = 400, {"error": str(e)}, None, {}
+                except Exception as e:
+                    status, payload, ctype, extra = 500, {"error": f"{type(e).__name__}: {e}"}, None, {}
+                await self._send(writer, status, payload, ctype, extra, keep_alive)
+                if not keep_alive:
+                    return
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _send(self, writer, status: int, payload, ctype: Optional[str] = None, extra: Optional[Dict[str, str]] = None, keep_alive: bool = True) -> None:
+        if isinstance(payload, bytes):
+            data = payload
+        else:
+            data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            ctype = "application/json; charset=utf-8"
+        head = [
+            f"HTTP/1.1 {status} {_REASONS.get(status, '')}",
+            f"Content-Type: {ctype}",
+            f"Content-Length: {len(data)}",
+            f"Connection: {'keep-alive' if keep_alive else 'close'}",
+        ]
+        head += [f"{k}: {v}" for k, v in (extra or {}).items()]
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + data)
+        await writer.drain()
+
+    async def _dispatch(self, method: str, target: str, body: bytes) -> Tuple[int, object, Optional[str], Dict[str, str]]:
+        u = urlsplit(target)
+        parts = [x for x in u.path.split("/") if x]
+        query = parse_qs(u.query)
+        route = (method, parts[0] if parts else "", len(parts))
+        if route == ("GET", "health", 1):
+            return 200, self._health(), None, {}
+        if route == ("GET", "templates", 1):
+            q = (query.get("q") or [""])[0]
+            return 200, {"templates": dg.search_templates(q) if q else dg.template_list()}, None, {}
+        if route == ("GET", "templates", 2):
+            t = dg.get_template(parts[1])
+            if not t:
+                raise HttpError(404, "模板不存在")
+            return 200, {"id": t.id, "name": t.name, "description": t.description, "fields": list(t.fields), "styles": list(t.styles)}, None, {}
+        if route == ("POST", "render", 2) and parts[1] == "text":
+            return 200, {"text": await _render_text(_json_body(body))}, None, {}
+        if route == ("POST", "render", 2) and parts[1] == "image":
+            return await self._render_image(_json_body(body))
+        if route == ("POST", "batch", 1):
+            return 202, self._submit_batch(_json_body(body)), None, {}
+        if route == ("GET", "batch", 2):
+            job = self._jobs.get(parts[1])
+            if job is None:
+                raise HttpError(404, "任务不存在")
+            return 200, job, None, {}
+        if parts and parts[0] in ("health", "templates", "render", "batch"):
+            raise HttpError(405, "不支持的请求方法")
+        raise HttpError(404, "接口不存在")
+
+    async def _render_image(self, req: Dict):
+        text = req.get("text")
+        if not isinstance(text, str):
+            text = await _render_text(req)
+        hw_style = _hw_style(req.get("hw_style")) or self.hw_style
+        compositor = req.get("compositor")
+        if compositor is not None and compositor not in _COMPOSITORS:
+            raise HttpError(400, f"compositor 只能是：{', '.join(_COMPOSITORS)}")
+        loop = asyncio.get_running_loop()
+        path = await loop.run_in_executor(self._pool, _render_image, text, hw_style, compositor)
+        key = os.path.splitext(os.path.basename(path))[0]
+        if req.get("return") == "path":
+            return 200, {"path": path, "key": key}, None, {}
+        data = await loop.run_in_executor(None, _read_bytes, path)
+        return 200, data, "image/png", {"X-Cache-Key": key}
+
+    def _submit_batch(self, req: Dict) -> Dict:
+        records = req.get("records")
+        if not isinstance(records, list):
+            raise HttpError(400, "records 必须是数组")
+        formats = req.get("formats") or ["txt"]
+        if not isinstance(formats, list):
+            raise HttpError(400, "formats 必须是数组")
+        bad = [x for x in formats if not isinstance(x, str) or x not in pipeline._WRITERS]
+        if bad:
+            raise HttpError(400, f"不支持的输出格式：{', '.join(map(str, bad))}")
+        recs = [_record(r, i) for i, r in enumerate(records)]
+        if not self._batch_slots.acquire(blocking=False):
+            raise HttpError(503, "批量任务过多，请稍后再试")
+        job_id = uuid.uuid4().hex
+        if len(self._jobs) >= _KEEP_JOBS:
+            # Forget the oldest finished jobs (dicts keep insertion order)
+            for k in [k for k, j in self._jobs.items() if j["status"] in ("done", "failed")][: len(self._jobs) - _KEEP_JOBS + 1]:
+                del self._jobs[k]
+        # Clients never choose where files go
+        out_dir = os.path.abspath(os.path.join("batch_output", job_id))
+        job = {"id": job_id, "status": "queued", "records": len(records), "out_dir": out_dir, "stats": None, "error": ""}
+        self._jobs[job_id] = job
+
+        def run():
+            job["status"] = "running"
+            try:
+                job["stats"] = pipeline.run_pipeline(recs, out_dir, formats, png_workers=self.workers, hw_style=self.hw_style, image_pool=self._pool)
+                job["status"] = "done"
+            except Exception as e:
+                job["status"] = "failed"
+                job["error"] = f"{type(e).__name__}: {e}"
+            finally:
+                self._batch_slots.release()
+
+        threading.Thread(target=run, name=f"batch-{job_id[:8]}", daemon=True).start()
+        return {"job_id": job_id, "status": job["status"]}
+
+    def _health(self) -> Dict:
+        return {
+            "status": "ok",
+            "uptime": round(time.time() - self.started, 1),
+            "requests": self.requests,
+            "workers": self.workers,
+            "templates": len(dg.template_list()),
+            "jobs": {s: sum(1 for j in self._jobs.values() if j["status"] == s) for s in ("queued", "running", "done", "failed")},
+            "line_cache": dg.line_cache_stats(),
+            "learned_defaults": dg.learned_defaults_stats(),
+        }
+
+
+def _json_body(body: bytes) -> Dict:
+    try:
+        req = json.loads(body.decode("utf-8") or "{}")
+    except ValueError:
+        raise HttpError(400, "请求体不是合法的JSON")
+    if not isinstance(req, dict):
+        raise HttpError(400, "请求体必须是JSON对象")
+    return req
+
+
+def _str(req: Dict, key: str) -> str:
+    v = req.get(key)
+    if not isinstance(v, str) or not v:
+        raise HttpError(400, f"缺少参数：{key}")
+    return v
+
+
+def _data(req: Dict, key: str = "data") -> Dict[str, str]:
+    d = req.get(key) or {}
+    if not isinstance(d, dict):
+        raise HttpError(400, f"{key} 必须是对象")
+    return {str(k): "" if v is None else str(v) for k, v in d.items()}
+
+
+def _style(req: Dict) -> str:
+    v = req.get("style") or "formal"
+    if not isinstance(v, str):
+        raise HttpError(400, "style 必须是字符串")
+    return v
+
+
+def _record(r, i: int) -> Dict:
+    if not isinstance(r, dict):
+        raise HttpError(400, f"records[{i}] 必须是对象")
+    for key in ("template_id", "name"):
+        if r.get(key) is not None and not isinstance(r[key], str):
+            raise HttpError(400, f"records[{i}].{key} 必须是字符串")
+    try:
+        return {"template_id": r.get("template_id") or "", "style": _style(r), "name": r.get("name") or "", "fields": _data(r, "fields")}
+    except HttpError as e:
+        raise HttpError(400, f"records[{i}].{e}")
+
+
+def _hw_style(v) -> Optional[Dict]:
+    if v is None:
+        return None
+    if not isinstance(v, dict):
+        raise HttpError(400, "hw_style 必须是对象")
+    out: Dict = {}
+    for k, x in v.items():
+        if k == "font_name":
+            if not isinstance(x, str) or dg.resolve_font_face(x) is None:
+                raise HttpError(400, f"字体不可用：{x}")
+            out[k] = x
+        elif k == "compositor":
+            if x not in _COMPOSITORS:
+                raise HttpError(400, f"compositor 只能是：{', '.join(_COMPOSITORS)}")
+            out[k] = x
+        elif k in _HW_LIMITS:
+            lo, hi = _HW_LIMITS[k]
+            if isinstance(x, bool) or not isinstance(x, (int, float)) or not lo <= x <= hi:
+                raise HttpError(400, f"hw_style.{k} 必须在 {lo}~{hi} 之间")
+            out[k] = x
+        else:
+            raise HttpError(400, f"hw_style 不支持字段：{k}")
+    return out
+
+
+async def _render_text(req: Dict) -> str:
+    args = (_str(req, "template_id"), _data(req), _style(req))
+    return await asyncio.get_running_loop().run_in_executor(None, dg.generate_document, *args)
+
+
+def _read_bytes(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+async def serve(host: str, port: int, workers: Optional[int] = None, hw_style: Optional[Dict[str, str]] = None) -> None:
+    app = DocServer(workers, hw_style)
+    srv = await app.start(host, port)
+    addrs = ", ".join(f"{a[0]}:{a[1]}" for a in (s.getsockname() for s in srv.sockets))
+    print(f"文书服务已启动：http://{addrs}")
+    try:
+        async with srv:
+            await srv.serve_forever()
+    finally:
+        app.close()
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    ap = argparse.ArgumentParser(description="文书生成HTTP服务（JSON接口）")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--workers", type=int, default=0, help="手写图片渲染进程数，默认CPU核数-1")
+    ap.add_argument("--font-name", default="", help="默认手写图片字体，如 手写-马善政、宋体")
+    args = ap.parse_args(argv)
+    hw_style = {"font_name": args.font_name} if args.font_name else None
+    try:
+        asyncio.run(serve(args.host, args.port, args.workers or None, hw_style))
+    except KeyboardInterrupt:
+        pass
+    except OSError as e:
+        print(f"错误：{e}", file=sys.stderr)
+        return 2
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,266 @@
+import json
+import os
+import random
+import sys
+import threading
+from datetime import datetime
+
+import pytest
+
+import document_gen as dg
+
+GOLDEN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_golden_outputs.json")
+STYLES = ["formal", "neutral", "strict", "other"]
+# Field values that exercise the style rules, the preamble headings and reason
+# capture, format-like braces, backslashes and blank-line normalisation
+SAMPLES = [
+    "请求返还款项", "依据合同提交处理", "违约请求：诉讼请求", "事实与理由：依据", "委托事项：请假事由：x",
+    "民事起诉状", "合同协议书", "授权委托书", "请假申请", "合同协议书\n\n", "民事起诉状\n", "案由：A。",
+    "请假事由：B\n", "。。。", "  空格 \n", "{大括号}", "张三", "",
+]
+
+
+class _FixedDate(datetime):
+    @classmethod
+    def now(cls, tz=None):
+        return cls(2024, 5, 6, 9, 30)
+
+
+def golden_cases(mod):
+    rnd = random.Random(20240506)
+    for t in mod.list_templates():
+        fields = mod.template_fields(t.id)
+        for style in STYLES:
+            yield f"{t.id}|{style}|empty", t.id, {}, style
+            yield f"{t.id}|{style}|full", t.id, {f: f"{f}内容" for f in fields}, style
+            for k in range(8):
+                data = {f: "".join(rnd.choice(SAMPLES) for _ in range(rnd.randint(1, 2))) for f in fields if rnd.random() < 0.75}
+                yield f"{t.id}|{style}|{k}", t.id, data, style
+
+
+@pytest.fixture
+def engine(tmp_path, monkeypatch):
+    # No learned defaults or house styles from the developer's working copy
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(dg, "datetime", _FixedDate)
+    dg._learned_cache.invalidate()
+    dg.reload_styles()
+    yield dg
+    dg._learned_cache.invalidate()
+    dg.reload_styles()
+
+
+def test_golden_outputs(engine):
+    # Every template x style against outputs recorded from the original engine
+    with open(GOLDEN, "r", encoding="utf-8") as f:
+        expected = json.load(f)
+    got = {key: engine.generate_document(tid, data, style) for key, tid, data, style in golden_cases(engine)}
+    assert set(got) == set(expected)
+    bad = [k for k in expected if got[k] != expected[k]]
+    assert not bad, f"{len(bad)} outputs differ, first: {bad[0]}"
+
+
+def test_builtin_styles_match_styles_json():
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "styles.json"), "r", encoding="utf-8") as f:
+        assert json.load(f) == dg._BUILTIN_STYLES
+
+
+def test_missing_styles_json_uses_builtin(engine, monkeypatch):
+    monkeypatch.setattr(engine, "_STYLE_FILE", "missing_styles.json")
+    engine.reload_styles()
+    assert engine.style_names() == ["formal", "neutral", "strict"]
+    assert "兹委托受托人依法办理相关事宜。" in engine.generate_document("power_of_attorney", {}, "formal")
+
+
+def _leave_rows(n, start=0):
+    return [{"template_id": "leave", "field": "请假事由", "value": f"事由{i}", "ts": 1} for i in range(start, start + n)]
+
+
+def test_compaction_threshold_survives_restart(engine, monkeypatch):
+    # Unique values keep the compacted log big; a new process must not
+    # compact again until the log has doubled
+    monkeypatch.setattr(engine, "_TRAIN_COMPACT_BYTES", 2000)
+    engine._append_training_rows(_leave_rows(100))
+    ino = os.stat(engine._TRAIN_LOG).st_ino
+    size = os.path.getsize(engine._TRAIN_LOG)
+    assert engine._compacted_size() == size > 2000
+    engine._append_training_rows(_leave_rows(10, 100))
+    assert os.stat(engine._TRAIN_LOG).st_ino == ino
+    engine._append_training_rows(_leave_rows(200, 110))
+    assert os.stat(engine._TRAIN_LOG).st_ino != ino
+    assert sum(r["n"] for r in engine._iter_training_rows()) == 310
+
+
+def test_training_on_empty_directory(engine):
+    assert engine.run_training() == {}
+    assert engine.training_top_values() == {}
+
+
+def test_training_migrates_legacy_file(engine):
+    with open(engine._TRAIN_FILE, "w", encoding="utf-8") as f:
+        json.dump({"rows": _leave_rows(1) + _leave_rows(1)}, f, ensure_ascii=False)
+    assert engine.run_training() == {"leave": {"请假事由": "事由0"}}
+    assert not os.path.exists(engine._TRAIN_FILE)
+    assert engine.training_top_values() == {"leave": {"请假事由": ["事由0"]}}
+
+
+def _full_argmax(rows):
+    # run_training as it was before the incremental counts: a full recount,
+    # first-seen value wins ties
+    counts = {}
+    for r in rows:
+        c = counts.setdefault(r["template_id"], {}).setdefault(r["field"], {})
+        c[r["value"]] = c.get(r["value"], 0) + 1
+    return {tid: {f: max(c, key=c.get) for f, c in fd.items()} for tid, fd in counts.items()}
+
+
+def test_incremental_training_matches_full_recount(engine):
+    rnd = random.Random(7)
+    rows = []
+    for batch in range(12):
+        new = [
+            {"template_id": rnd.choice(["leave", "contract"]), "field": rnd.choice(["甲", "乙"]), "value": rnd.choice("ABCD"), "ts": 1}
+            for _ in range(rnd.randint(1, 6))
+        ]
+        engine._append_training_rows(new)
+        rows += new
+        if batch == 5:
+            # Rows collapse into counted ones and the log gets a new inode
+            engine.compact_training_log()
+        if batch == 8:
+            # Replaced by another process with the same content
+            with open(engine._TRAIN_LOG, "rb") as f:
+                raw = f.read()
+            with open(engine._TRAIN_LOG + ".new", "wb") as f:
+                f.write(raw)
+            os.replace(engine._TRAIN_LOG + ".new", engine._TRAIN_LOG)
+        assert engine.run_training() == _full_argmax(rows), batch
+
+
+def test_history_retention_sweeps_unreferenced_blobs(engine, monkeypatch):
+    monkeypatch.setattr(engine, "_history_retention", 3)
+    for i in range(1, 257):
+        engine.add_history("leave", {"请假事由": "看病"}, f"请假申请\n第{i}份", None)
+    con = engine._history_db()
+    assert [r["id"] for r in con.execute("SELECT id FROM entries ORDER BY id")] == [254, 255, 256]
+    # The sweep runs every 256 inserts: three texts and the shared data blob remain
+    assert con.execute("SELECT COUNT(*) FROM blobs").fetchone()[0] == 4
+    assert engine.get_history(254)["text"] == "请假申请\n第254份"
+    assert engine.get_history(254)["data"] == {"请假事由": "看病"}
+
+
+def test_list_history_returns_resolved_entries(engine):
+    engine.add_history("leave", {"请假事由": "看病"}, "旧", None)
+    engine.add_history("leave", {"请假事由": "出差"}, "新", None)
+    assert [(it["text"], it["data"]) for it in engine.list_history()] == [("新", {"请假事由": "出差"}), ("旧", {"请假事由": "看病"})]
+    assert engine.latest_history_for_template("leave")["text"] == "新"
+    light = engine.list_history_entries(limit=1)[0]
+    assert "text" not in light and engine.resolve_history(light)["text"] == "新"
+
+
+def test_history_imports_legacy_json(engine):
+    items = [{"ts": 2, "template_id": "leave", "data": {"a": "1"}, "text": "新", "image_path": ""},
+             {"ts": 1, "template_id": "contract", "data": {}, "text": "旧", "image_path": ""}]
+    with open(engine._HISTORY_FILE, "w", encoding="utf-8") as f:
+        json.dump({"items": items}, f, ensure_ascii=False)
+    assert [(it["template_id"], it["title"]) for it in engine.history_page()["items"]] == [("leave", "新"), ("contract", "旧")]
+    assert not os.path.exists(engine._HISTORY_FILE)
+
+
+def test_history_page_has_more_and_escapes_like(engine):
+    for i in range(5):
+        engine.add_history("leave", {}, f"请假申请{i}", None)
+    engine.add_history("contract", {}, "合同 100%_完成", None)
+    engine.add_history("contract", {}, "合同 1000完成", None)
+    first = engine.history_page(0, 2, "leave")
+    assert [it["title"] for it in first["items"]] == ["请假申请4", "请假申请3"] and first["has_more"]
+    last = engine.history_page(2, 2, "leave")
+    assert [it["title"] for it in last["items"]] == ["请假申请0"] and not last["has_more"]
+    assert not engine.history_page(0, 2, "leave", "申请4")["has_more"]
+    # % and _ are literal in the search, not LIKE wildcards
+    assert [it["title"] for it in engine.history_page(query="100%_")["items"]] == ["合同 100%_完成"]
+    assert engine.history_page(query="contract 完成")["has_more"] is False
+    assert len(engine.history_page(query="contract 完成")["items"]) == 2
+
+
+def test_pinyin_initials_without_pypinyin(monkeypatch):
+    monkeypatch.setitem(sys.modules, "pypinyin", None)
+    assert dg.pinyin_initials("请假申请") == "qjsq"
+    assert dg.pinyin_initials("会议纪要A1") == "hyjya1"
+
+
+def test_template_search(monkeypatch):
+    monkeypatch.setitem(sys.modules, "pypinyin", None)
+    idx = dg._TemplateSearch(dg.list_templates())
+    assert idx.search("qjsq") == ["leave"]
+    assert idx.search("hyjy") == ["meeting_minutes"]
+    assert idx.search("申请 实习") == ["internship_application"]
+    # Name/initials prefix hits rank first (xm: 项目立项申请, then 姓名 fields)
+    assert idx.search("xm")[0] == "project_proposal" and len(idx.search("xm")) > 1
+    # Narrowing reuses the last hits, widening rescans everything
+    assert idx.search("qj") == ["leave"]
+    assert len(idx.search("q")) == len(dg.list_templates())
+    assert idx.search("") == [t.id for t in dg.list_templates()]
+    assert idx.search("不存在的词") == []
+
+
+def test_template_search_keeps_per_thread_state(monkeypatch):
+    monkeypatch.setitem(sys.modules, "pypinyin", None)
+    idx = dg._TemplateSearch(dg.list_templates())
+    assert idx.search("qj") == ["leave"]
+    other = []
+    t = threading.Thread(target=lambda: other.append(idx.search("q")))
+    t.start()
+    t.join()
+    assert len(other[0]) > 1
+    assert idx.search("qjs") == ["leave"]
+    assert idx._local.last[0] == "qjs"
+
+
+def test_non_utf8_state_file_is_backed_up(engine, capsys):
+    raw = json.dumps({"leave": {"请假事由": "看病"}}, ensure_ascii=False).encode("gbk")
+    with open(engine._LEARNED_FILE, "wb") as f:
+        f.write(raw)
+    assert engine._load_json(engine._LEARNED_FILE) == {}
+    with open(engine._LEARNED_FILE + ".corrupt", "rb") as f:
+        assert f.read() == raw
+    assert "警告" in capsys.readouterr().err
+    engine._learned_cache.invalidate()
+    assert engine.generate_document("leave", {}, "formal")
+
+
+def test_save_json_retries_busy_target(engine, monkeypatch):
+    real, calls = os.replace, []
+
+    def flaky(src, dst):
+        calls.append(dst)
+        if len(calls) < 3:
+            raise PermissionError(13, "in use", dst)
+        real(src, dst)
+
+    monkeypatch.setattr(engine.os, "replace", flaky)
+    engine._save_json("state.json", {"a": 1})
+    assert len(calls) == 3
+    assert engine._load_json("state.json") == {"a": 1}
+
+
+def test_auto_image_lands_in_out_dir(engine, monkeypatch, tmp_path):
+    cached = tmp_path / "cache.png"
+    cached.write_bytes(b"png")
+    monkeypatch.setattr(engine, "render_handwriting_cached", lambda text, *a, **k: str(cached))
+    path = engine.auto_generate_image_for_document("leave", {}, out_dir=str(tmp_path / "out"))
+    assert os.path.dirname(path) == str(tmp_path / "out")
+    assert os.path.basename(path).startswith("leave_") and path.endswith(".png")
+    with open(path, "rb") as f:
+        assert f.read() == b"png"
+    path = engine.auto_generate_image_for_document("leave", {})
+    assert os.path.dirname(path) == os.path.join(os.getcwd(), "handwrite_output")
+
+
+if __name__ == "__main__":
+    # Re-record the golden file (only after an intended output change)
+    dg.datetime = _FixedDate
+    out = {key: dg.generate_document(tid, data, style) for key, tid, data, style in golden_cases(dg)}
+    with open(GOLDEN, "w", encoding="utf-8") as f:
+        json.dump(out, f, ensure_ascii=False, indent=0, sort_keys=True)
+    print(f"{len(out)} outputs written to {GOLDEN}")
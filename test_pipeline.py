@@ -0,0 +1,45 @@
+import os
+
+import pytest
+
+import document_gen as dg
+import pipeline
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    dg._learned_cache.invalidate()
+    dg.reload_styles()
+    return tmp_path
+
+
+def _write(path, text, encoding="utf-8"):
+    with open(path, "w", encoding=encoding, newline="") as f:
+        f.write(text)
+    return str(path)
+
+
+def test_jsonl_bad_lines_are_reported_not_raised(workdir):
+    src = _write(workdir / "in.jsonl", '{"template_id": "leave", "name": "a"}\n{oops\n[1, 2]\n\n{"template_id": "leave", "name": "b"}\n')
+    stats = pipeline.run_pipeline(pipeline.read_records(src), str(workdir / "out"))
+    assert stats["records"] == 4
+    assert stats["written"]["txt"] == 2
+    assert [(e["name"], e["stage"]) for e in stats["errors"]] == [("line 2", "read"), ("line 3", "read")]
+    assert "第2行" in stats["errors"][0]["error"]
+    assert sorted(os.listdir(workdir / "out")) == ["a.txt", "b.txt"]
+
+
+def test_csv_with_utf8_bom(workdir):
+    src = _write(workdir / "in.csv", "template_id,name,请假事由\nleave,a,看病\n", encoding="utf-8-sig")
+    recs = list(pipeline.read_records(src))
+    assert recs == [{"template_id": "leave", "style": "formal", "name": "a", "fields": {"请假事由": "看病"}}]
+    stats = pipeline.run_pipeline(recs, str(workdir / "out"))
+    assert stats["errors"] == [] and stats["written"]["txt"] == 1
+
+
+def test_repeated_names_do_not_overwrite(workdir):
+    recs = [{"template_id": "leave", "name": n, "fields": {"请假事由": n}} for n in ("a", "a", "A", "a/", "a_2")]
+    stats = pipeline.run_pipeline(recs, str(workdir / "out"))
+    assert stats["errors"] == [] and stats["written"]["txt"] == 5
+    assert sorted(os.listdir(workdir / "out")) == sorted(["a.txt", "a_2.txt", "A_3.txt", "a_.txt", "a_2_2.txt"])
@@ -0,0 +1,25 @@
+import threading
+
+from render_service import RenderService
+
+
+def test_callback_sees_service_idle():
+    # A GUI callback asks busy() to decide whether to stop its progress bar
+    seen = []
+    svc = None
+
+    def dispatch(call):
+        seen.append(svc.busy())
+        call()
+
+    svc = RenderService(workers=1, dispatch=dispatch)
+    try:
+        ok, err = threading.Event(), threading.Event()
+        svc.submit("k", lambda: 1, on_done=lambda v: ok.set())
+        assert ok.wait(5)
+        svc.submit("k", lambda: 1 / 0, on_error=lambda e: err.set())
+        assert err.wait(5)
+    finally:
+        svc.shutdown()
+    assert seen == [False, False]
+    assert not svc._latest
@@ -0,0 +1,112 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import document_gen as dg
+import pipeline
+import server
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    dg._learned_cache.invalidate()
+    dg.reload_styles()
+    return server.DocServer(workers=1)
+
+
+def call(app, method, target, body=None):
+    raw = json.dumps(body, ensure_ascii=False).encode("utf-8") if body is not None else b""
+    try:
+        status, payload, _, _ = asyncio.run(app._dispatch(method, target, raw))
+    except server.HttpError as e:
+        return e.status, {"error": str(e)}
+    return status, payload
+
+
+def wait_job(app, job_id):
+    for _ in range(200):
+        job = app._jobs[job_id]
+        if job["status"] in ("done", "failed"):
+            return job
+        time.sleep(0.01)
+    raise AssertionError("batch job did not finish")
+
+
+def test_batch_output_stays_in_job_dir(app, tmp_path):
+    status, res = call(app, "POST", "/batch", {"records": [{"template_id": "leave", "name": "../../pwned"}], "out_dir": str(tmp_path / "abs")})
+    assert status == 202
+    job = wait_job(app, res["job_id"])
+    assert job["status"] == "done" and job["stats"]["written"]["txt"] == 1
+    assert job["out_dir"] == os.path.abspath(os.path.join("batch_output", res["job_id"]))
+    assert os.listdir(job["out_dir"]) == ["_.._pwned.txt"]
+    assert sorted(os.listdir(tmp_path)) == ["batch_output"]
+
+
+@pytest.mark.parametrize("body", [
+    {"records": [{"template_id": "leave", "style": ["formal"]}]},
+    {"records": [[1, 2]]},
+    {"records": [{"template_id": "leave", "fields": "x"}]},
+    {"records": [], "formats": [["txt"]]},
+])
+def test_batch_rejects_bad_records(app, body):
+    status, res = call(app, "POST", "/batch", body)
+    assert status == 400, res
+
+
+def test_render_text_rejects_non_string_style(app):
+    assert call(app, "POST", "/render/text", {"template_id": "leave", "style": ["formal"]})[0] == 400
+
+
+@pytest.mark.parametrize("hw_style", [{"font": "/etc/passwd"}, {"font_size": 100000}, {"jitter": "2"}, {"font_name": "no-such-font"}, "x"])
+def test_render_image_rejects_bad_hw_style(app, hw_style):
+    assert call(app, "POST", "/render/image", {"text": "测试", "hw_style": hw_style})[0] == 400
+
+
+def test_pipeline_sends_image_writes_to_pool(tmp_path, monkeypatch):
+    written = []
+    monkeypatch.setitem(pipeline._WRITERS, "png", lambda text, path, style: written.append(os.path.basename(path)))
+
+    class Pool(ThreadPoolExecutor):
+        submitted = 0
+
+        def submit(self, fn, *args, **kwargs):
+            Pool.submitted += 1
+            return super().submit(fn, *args, **kwargs)
+
+    with Pool(1) as pool:
+        stats = pipeline.run_pipeline([{"template_id": "leave", "name": "a"}], str(tmp_path), ["txt", "png"], hw_style={}, image_pool=pool)
+    assert stats["errors"] == [] and Pool.submitted == 1 and written == ["a.png"]
+
+
+def test_text_rendering_leaves_the_event_loop(app, monkeypatch):
+    threads = []
+    real = dg.generate_document
+
+    def spy(*args):
+        threads.append(threading.current_thread())
+        return real(*args)
+
+    monkeypatch.setattr(dg, "generate_document", spy)
+    assert call(app, "POST", "/render/text", {"template_id": "leave"})[0] == 200
+    assert threads and threads[0] is not threading.main_thread()
+
+
+def test_oversized_header_line_gets_400(app):
+    async def go():
+        srv = await asyncio.start_server(app._handle, "127.0.0.1", 0)
+        port = srv.sockets[0].getsockname()[1]
+        async with srv:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(b"GET /health HTTP/1.1\r\nX-Big: " + b"a" * 200000 + b"\r\n\r\n")
+            await writer.drain()
+            status = await reader.readline()
+            writer.close()
+            return status
+
+    assert asyncio.run(go()).startswith(b"HTTP/1.1 400")